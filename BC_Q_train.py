@@ -1,13 +1,15 @@
 import gym
 from Model.class_model import  BC_agent, TD3_Agent
 from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
 import numpy as np
 import torch
 import d4rl
-from Utils.utils import d4rl_dataset
+from Utils.utils import d4rl_dataset, dataset_kwargs
 
 
 args = get_args()
+configure_threads(args, 'TD3')
 
 # env = gym.make("InvertedPendulum-v2")
 env = gym.make(args.task_name)
@@ -21,7 +23,7 @@ agent = TD3_Agent(state_dim,action_dim,args)
 agent.init_pi("./model_save/bc/bc_"+args.task_name+"_100.pt")
 #agent.init_pi("./model_save/bc_wq/bc_wq_halfcheetah-random-v2_600__123.pt")
 
-dataset = d4rl_dataset(env.unwrapped)
+dataset = d4rl_dataset(env.unwrapped, **dataset_kwargs(args))
 
 maximum_step = 100000
 local_step = 0
@@ -44,6 +46,6 @@ while local_step <=maximum_step:
       print("[local_step] :",local_step+1, "Q1 : ",sum(q1)/batch[0].shape[0],"Q2 : ",sum(q2)/batch[0].shape[0])
 
   if local_step % 20000 == 19999:
-    torch.save({'q1': agent.q1.state_dict(),
-                'q2': agent.q2.state_dict(),
+    torch.save({'q1': agent.q.qnet_state_dict(0),
+                'q2': agent.q.qnet_state_dict(1),
                 }, "./model_save/bc_q/bc_"+args.task_name+"cql"+str(cql)+"_"+ str(local_step + 1) + ".pt")
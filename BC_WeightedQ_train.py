@@ -1,13 +1,15 @@
 import gym
 from Model.class_model import  BC_agent
 from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
 import numpy as np
 import torch
 import d4rl
-from Utils.utils import d4rl_dataset
+from Utils.utils import d4rl_dataset, dataset_kwargs
 
 
 args = get_args()
+configure_threads(args, 'TD3')
 
 # env = gym.make("InvertedPendulum-v2")
 env = gym.make(args.task_name)
@@ -22,7 +24,7 @@ agent.init_bc("./model_save/bc/bc_"+args.task_name+"_100.pt")
 agent.init_q("./model_save/bc_q/bc_"+args.task_name+"cqlTrue_"+"100000.pt")
 #agent.init_bc("./model_save/bc_wq/bc_wq_halfcheetah-random-v2_600__123.pt")
 #agent.init_q("./model_save/bc_q_test/bc_"+args.task_name+"cqlTrue_"+"100000.pt")
-dataset = d4rl_dataset(env.unwrapped)
+dataset = d4rl_dataset(env.unwrapped, **dataset_kwargs(args))
 
 
 
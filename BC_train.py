@@ -1,13 +1,16 @@
 import gym
 from Model.class_model import  BC_agent
 from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
 import numpy as np
 import torch
 import d4rl
-from Utils.utils import d4rl_dataset
+from Utils.utils import d4rl_dataset, dataset_kwargs
+from Utils.prefetch import Prefetcher
 
 
 args = get_args()
+configure_threads(args, 'TD3')
 
 # env = gym.make("InvertedPendulum-v2")
 env = gym.make(args.task_name)
@@ -18,7 +21,11 @@ epi_length = env.spec.max_episode_steps
 
 
 agent = BC_agent(state_dim,action_dim,args)
-dataset = d4rl_dataset(env.unwrapped)
+dataset = d4rl_dataset(env.unwrapped, **dataset_kwargs(args))
+if args.prefetch > 0:
+  batches = Prefetcher(dataset.get_data, num_prefetch=args.prefetch, device=args.device_train)
+else:
+  batches = iter(dataset.get_data, None)
 
 maximum_step = 1000000
 local_step = 0
@@ -30,36 +37,41 @@ eval_num=5
 n_train_step_per_epoch=1000
 
 
-while local_step <=maximum_step:
-  state = env.reset()
-  for step in range(n_train_step_per_epoch):
-    batch = dataset.get_data()
-    local_step += 1
-    agent.train_bc(batch)
-  episode_step += 1
+try:
+  while local_step <=maximum_step:
+    state = env.reset()
+    for step in range(n_train_step_per_epoch):
+      batch = next(batches)
+      local_step += 1
+      agent.train_bc(batch)
+    episode_step += 1
 
-  #====Eval====
-  if episode_step % eval_period == 0:
-    epi_return = []  # 나중에 success까지 포함해야할듯
-    for eval_epi in range(eval_num):
-      state = env.reset()
-      total_reward = 0
-      for step in range(epi_length):
-        # if eval_epi == (eval_num-1):
-        #     env.render()
-        action = agent.select_action(state.reshape([1,-1]),eval=True)
-        state, rwd, done, _ = env.step(action * action_max)
-        total_reward += rwd
-        if done:
-          break
-      epi_return.append(total_reward)
-    print("==================[Eval]====================")
-    print("Epi : ", episode_step)
-    print("Mean return  : ", np.mean(epi_return), "Min return", np.min(epi_return), "Max return", np.max(epi_return))
+    #====Eval====
+    if episode_step % eval_period == 0:
+      epi_return = []  # 나중에 success까지 포함해야할듯
+      for eval_epi in range(eval_num):
+        state = env.reset()
+        total_reward = 0
+        for step in range(epi_length):
+          # if eval_epi == (eval_num-1):
+          #     env.render()
+          action = agent.select_action(state.reshape([1,-1]),eval=True)
+          state, rwd, done, _ = env.step(action * action_max)
+          total_reward += rwd
+          if done:
+            break
+        epi_return.append(total_reward)
+      print("==================[Eval]====================")
+      print("Epi : ", episode_step)
+      print("Mean return  : ", np.mean(epi_return), "Min return", np.min(epi_return), "Max return", np.max(epi_return))
 
-  # if episode_step % 20 == 19:
-  #   torch.save({'policy': agent.bc.state_dict(),
-  #               }, "./model_save/bc/bc_"+args.task_name+"_"+str(episode_step + 1) + ".pt")
+    # if episode_step % 20 == 19:
+    #   torch.save({'policy': agent.bc.state_dict(),
+    #               }, "./model_save/bc/bc_"+args.task_name+"_"+str(episode_step + 1) + ".pt")
+finally:
+  # Ctrl-C나 에러로 끝나도 prefetch thread 정리
+  if args.prefetch > 0:
+    batches.close()
 
 #medium-expert
 # [EPI5] : 4465.38
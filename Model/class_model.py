@@ -1,11 +1,107 @@
+import os
+import json
+import shutil
 import torch
 import torch.nn as nn
-from Model.model import Qnet, Policy, Det_Policy, soft_update, hard_update
+from Model.model import EnsembleQnet, Policy, Det_Policy, soft_update, hard_update, flatten_parameters, target_copy, set_autocast
+from Utils.sum_tree import PrioritizedSampler
+from Utils.precision import storage_dtype, done_dtype, encode, decode, quantization_error
 import numpy as np
 from torch.utils.data import DataLoader, Dataset
 from collections import deque
 from copy import deepcopy
 import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+
+
+def to_tensor(x, device):
+    # numpy batch는 as_tensor로 (cpu면 복사 없이), 이미 tensor인 batch (device-resident dataset)는 그대로 사용
+    if isinstance(x, torch.Tensor):
+        return x.to(device=device, dtype=torch.float32)
+    return torch.as_tensor(x, dtype=torch.float32, device=device)
+
+def unpack_batch(batch):
+    # (o, a, r, no, done) 뒤에 prioritized sampling의 idx, weights 같은 추가 정보 dict가 붙을 수 있음
+    return batch[:5], (batch[5] if len(batch) > 5 else {})
+
+def stack_batches(batches):
+    # batch K개를 train_many용 (K, B, ...) batch 하나로. extras dict는 key별로 쌓고 callback은 그대로
+    batches = [unpack_batch(batch) for batch in batches]
+    stacked = tuple(torch.stack([to_tensor(batch[i], None) for batch, _ in batches]) for i in range(5))
+    extras = {}
+    for key, value in batches[0][1].items():
+        extras[key] = value if callable(value) else torch.stack([torch.as_tensor(e[key]) for _, e in batches])
+    return stacked + ((extras,) if extras else ())
+
+def iterate_batches(batches, device, num_steps=None):
+    # train_many용: sampler (dataset.get_data 같은 callable)면 num_steps번 뽑고,
+    # (K, B, ...) batch면 device로 한번에 올린 다음 k번째 slice를 차례로 (step마다 host 변환 없음)
+    if callable(batches):
+        for _ in range(num_steps):
+            batch, extras = unpack_batch(batches())
+            yield tuple(to_tensor(x, device) for x in batch), extras
+        return
+    batch, extras = unpack_batch(batches)
+    batch = tuple(to_tensor(x, device) for x in batch)
+    for k in range(batch[0].shape[0] if num_steps is None else num_steps):
+        yield tuple(x[k] for x in batch), {key: (value if callable(value) else value[k]) for key, value in extras.items()}
+
+def run_updates(update_fn, batches, device, num_steps=None):
+    # update_fn이 step마다 돌려주는 loss (detach된 tensor)를 모아서 끝에서 한번만 host로 -> key별 평균
+    losses = {}
+    for batch, extras in iterate_batches(batches, device, num_steps):
+        for key, value in update_fn(*batch, extras).items():
+            losses.setdefault(key, []).append(value)
+    return {key: torch.stack(values).mean().item() for key, values in losses.items()}
+
+def batch_weights(extras, device):
+    if extras and 'weights' in extras:
+        return to_tensor(extras['weights'], device)
+    return None
+
+def td_discount(extras, gamma, done_batch, device):
+    # n-step dataset이면 row마다 gamma^k * (1-done)이 미리 계산되어 extras['discount']로 옴
+    if extras and 'discount' in extras:
+        return to_tensor(extras['discount'], device)
+    return gamma*(1-done_batch)
+
+def td_loss(target, q_vals, weights=None):
+    # q_vals는 ensemble critic 출력 (E, B). member별 MSE의 합 (= 기존 q1_loss + q2_loss)
+    if weights is None:
+        return ((target - q_vals)**2).mean(-1).sum()
+    return (weights * (target - q_vals)**2).mean(-1).sum()
+
+def update_priorities(extras, target, q_vals):
+    # prioritized batch면 |TD error| (member 평균)로 sampler의 priority 갱신
+    if extras and 'update_priorities' in extras:
+        td_error = (target - q_vals).abs().mean(0)
+        extras['update_priorities'](extras['idx'], td_error.detach().cpu().numpy().reshape(-1))
+
+def cql_q_values(q, state_batch, action_batch, random_actions, current_actions, next_actions):
+    # data action과 CQL action 3N개를 (B, 3N+1, a_dim)으로 묶어서 critic forward 한번 -> (E, B, 3N+1)
+    # 반환: data action Q (E, B), random / current / next action Q 각각 (E, B, N)
+    n_actions = random_actions.shape[1]
+    cql_actions = torch.cat([torch.unsqueeze(action_batch, 1), random_actions, current_actions, next_actions], dim=1)
+    cql_q = q(state_batch, cql_actions)
+    return (cql_q[..., 0], cql_q[..., 1:n_actions + 1],
+            cql_q[..., n_actions + 1:2 * n_actions + 1], cql_q[..., 2 * n_actions + 1:])
+
+def compile_update(agent, names, enabled):
+    # agent의 update method들을 torch.compile로 (CPU는 inductor). loss.backward()에서 graph break:
+    # forward+loss가 graph 하나 (그 backward graph도 AOTAutograd가 같이 compile, 실행은 eager autograd engine),
+    # break 뒤의 optimizer step은 resume frame에서 따로 graph 하나. backward까지 한 graph로 묶지는 않음.
+    # torch.compile이 없으면 그대로 eager. compile에 실패한 frame은 eager로 실행하고 dynamo가 warning log를 남김.
+    # suppress_errors는 process 전체 설정이라 바꿔두지 않고 compile된 method를 호출하는 동안만 patch
+    if not enabled or not hasattr(torch, 'compile'):
+        return
+    import torch._dynamo as dynamo
+    def suppress_errors(compiled):
+        def wrapped(*args, **kwargs):
+            with dynamo.config.patch(suppress_errors=True):
+                return compiled(*args, **kwargs)
+        return wrapped
+    for name in names:
+        setattr(agent, name, suppress_errors(torch.compile(getattr(agent, name))))
 
 class CustomDataSet(Dataset):
     def __init__(self,x,y):
@@ -17,42 +113,313 @@ class CustomDataSet(Dataset):
         return self.x[idx], self.y[idx]
 
 class Buffer:
-    def __init__(self,o_dim,a_dim,buffer_size = 1000000):
+    def __init__(self,o_dim,a_dim,buffer_size = 1000000,compact=False,prioritized=False,storage='float32'):
         self.size = buffer_size
+        self.compact = compact
+        self.sampler = PrioritizedSampler(self.size) if prioritized else None
+        # storage: obs, action 저장 형식 (float32, float16, bfloat16), batch로 뽑을 때만 float32로
+        self.storage = storage
+        # float32가 아니면 쓸 때마다 field별 최대 quantization error (quantization_error())
+        self.max_quantization_error = dict(observations=0.0, actions=0.0, next_observations=0.0)
         self.num_experience = 0
-        self.o_mem = np.empty((self.size, o_dim), dtype=np.float32)
-        self.a_mem = np.empty((self.size, a_dim), dtype=np.float32)
-        self.no_mem = np.empty((self.size, o_dim), dtype=np.float32)
+        self.o_mem = np.empty((self.size, o_dim), dtype=storage_dtype(storage))
+        self.a_mem = np.empty((self.size, a_dim), dtype=storage_dtype(storage))
         self.r_mem = np.empty((self.size, 1), dtype=np.float32)
-        self.done_mem = np.empty((self.size, 1), dtype=np.float32)
+        self.done_mem = np.empty((self.size, 1), dtype=done_dtype(storage))
+        if self.compact:
+            # no_mem 없이 o_mem 하나만 씀: idx의 next obs는 o_mem[(idx+1)%size].
+            # episode가 끝나면 (terminal, timeout) 마지막 next obs만 담긴 row(valid=False)가 하나 남고 다음 episode는 그 다음 칸부터
+            self.valid_mem = np.zeros(self.size, dtype=bool)
+            self.num_rows = 0
+            self.pending = False
+        else:
+            self.no_mem = np.empty((self.size, o_dim), dtype=storage_dtype(storage))
+    def track_quantization(self,o,a,no):
+        if self.storage == 'float32':
+            return
+        for key, error in quantization_error(dict(observations=o, actions=a, next_observations=no), self.storage).items():
+            self.max_quantization_error[key] = max(self.max_quantization_error[key], error)
+    def quantization_error(self):
+        # 지금까지 buffer에 쓴 row (덮어써진 row 포함)의 field별 최대 절대 오차, float32면 0
+        return dict(self.max_quantization_error)
     def store_sample(self,o,a,r,no,done):
+        self.track_quantization(o,a,no)
+        if self.compact:
+            self.store_sample_compact(o,a,r,no,done)
+            return
         idx = self.num_experience%self.size
+        self.o_mem[idx] = encode(o, self.storage)
+        self.a_mem[idx] = encode(a, self.storage)
+        self.r_mem[idx] = r
+        self.no_mem[idx] = encode(no, self.storage)
+        self.done_mem[idx] = done
+        if self.sampler is not None:
+            self.sampler.add(idx)
+        self.num_experience += 1
+    def store_sample_compact(self,o,a,r,no,done):
+        idx = self.num_rows%self.size
+        o = encode(o, self.storage)
+        if self.pending and not np.array_equal(self.o_mem[idx], o):
+            # 이전 transition의 next obs와 다르면 새 episode -> 이전 episode의 마지막 next obs row는 남겨둠
+            self.num_rows += 1
+            idx = self.num_rows%self.size
         self.o_mem[idx] = o
-        self.a_mem[idx] = a
+        self.a_mem[idx] = encode(a, self.storage)
         self.r_mem[idx] = r
-        self.no_mem[idx] = no
         self.done_mem[idx] = done
+        self.valid_mem[idx] = True
+        self.num_rows += 1
+        next_idx = self.num_rows%self.size
+        self.o_mem[next_idx] = encode(no, self.storage)
+        self.valid_mem[next_idx] = False
+        if self.sampler is not None:
+            self.sampler.add(idx)
+            self.sampler.remove(next_idx)
+        self.pending = True
         self.num_experience += 1
-    def random_batch(self, batch_size = 256):
-        N = min(self.num_experience, self.size)
+    def ring_write(self, mem, start, values):
+        # start부터 연속으로 씀, ring 끝을 넘어가면 두 조각 (len(values) <= size)
+        idx = start%self.size
+        first = min(len(values), self.size - idx)
+        mem[idx:idx+first] = values[:first]
+        mem[:len(values)-first] = values[first:]
+    def store_batch(self,o,a,r,no,done):
+        # N개 transition을 field당 slice copy 최대 두번으로 저장
+        self.track_quantization(o,a,no)
+        o, a, no = encode(o, self.storage), encode(a, self.storage), encode(no, self.storage)
+        r, done = np.asarray(r).reshape(-1, 1), np.asarray(done).reshape(-1, 1)
+        if self.compact:
+            self.store_batch_compact(o,a,r,no,done)
+            return
+        n = len(o)
+        # buffer보다 많이 들어오면 마지막 size개만 남음
+        skip = max(n - self.size, 0)
+        start = self.num_experience + skip
+        for mem, values in ((self.o_mem, o), (self.a_mem, a), (self.r_mem, r), (self.no_mem, no), (self.done_mem, done)):
+            self.ring_write(mem, start, values[skip:])
+        if self.sampler is not None:
+            self.sampler.add(np.arange(start, self.num_experience + n)%self.size)
+        self.num_experience += n
+    def store_batch_compact(self,o,a,r,no,done):
+        n = len(o)
+        # episode 경계: o[k]가 no[k-1]과 다르면 k에서 새 episode (store_sample_compact와 같은 기준)
+        new_episode = np.empty(n, dtype=bool)
+        new_episode[1:] = np.any(o[1:] != no[:-1], axis=1)
+        new_episode[0] = self.pending and not np.array_equal(self.o_mem[self.num_rows%self.size], o[0])
+        # transition k의 row 위치, 각 episode 끝에는 next obs만 담긴 row가 하나씩 붙음
+        offset = np.arange(n) + np.cumsum(new_episode)
+        episode_end = np.append(new_episode[1:], True)
+        n_rows = offset[-1] + 2
+        rows_o = np.empty((n_rows, o.shape[1]), dtype=self.o_mem.dtype)
+        rows_a = np.zeros((n_rows, a.shape[1]), dtype=self.a_mem.dtype)
+        rows_r = np.zeros((n_rows, 1), dtype=np.float32)
+        rows_done = np.zeros((n_rows, 1), dtype=self.done_mem.dtype)
+        rows_valid = np.zeros(n_rows, dtype=bool)
+        rows_o[offset], rows_a[offset], rows_r[offset], rows_done[offset] = o, a, r, done
+        rows_valid[offset] = True
+        rows_o[offset[episode_end]+1] = no[episode_end]
+        if new_episode[0]:
+            # 맨 앞 row는 이전 episode의 마지막 next obs가 이미 들어있는 칸
+            rows_o[0] = self.o_mem[self.num_rows%self.size]
+        skip = max(n_rows - self.size, 0)
+        start = self.num_rows + skip
+        for mem, values in ((self.o_mem, rows_o), (self.a_mem, rows_a), (self.r_mem, rows_r), (self.done_mem, rows_done), (self.valid_mem, rows_valid)):
+            self.ring_write(mem, start, values[skip:])
+        if self.sampler is not None:
+            slots = np.arange(start, self.num_rows + n_rows)%self.size
+            self.sampler.remove(slots[~rows_valid[skip:]])
+            self.sampler.add(slots[rows_valid[skip:]])
+        self.num_rows += n_rows - 1
+        self.pending = True
+        self.num_experience += n
+    def written_rows(self):
+        # 지금까지 ring에 쓴 row 수 (compact면 next obs만 있는 마지막 row 포함)
+        if self.compact:
+            return self.num_rows + int(self.pending)
+        return self.num_experience
+    def snapshot_fields(self):
+        fields = dict(o_mem=self.o_mem, a_mem=self.a_mem, r_mem=self.r_mem, done_mem=self.done_mem)
+        if self.compact:
+            fields['valid_mem'] = self.valid_mem
+        else:
+            fields['no_mem'] = self.no_mem
+        return fields
+    def save_snapshot(self,path,**tags):
+        # 이전 snapshot 이후에 쓴 row만 chunk 하나로 추가 저장, header.json에 num_experience와 ring 위치.
+        # tags (step 수 등)는 header['tags']로 (같이 저장한 agent checkpoint와 맞는지 확인용)
+        header_file = os.path.join(path, 'header.json')
+        if os.path.isfile(header_file):
+            with open(header_file) as f:
+                header = json.load(f)
+        else:
+            os.makedirs(path, exist_ok=True)
+            header = dict(chunks=[], saved_rows=0)
+        written = self.written_rows()
+        start = max(header['saved_rows'], written - self.size)
+        if written > start:
+            name = 'chunk_%08d' % start
+            chunk_dir = os.path.join(path, name)
+            os.makedirs(chunk_dir, exist_ok=True)
+            slots = np.arange(start, written)%self.size
+            for key, mem in self.snapshot_fields().items():
+                np.save(os.path.join(chunk_dir, key + '.npy'), mem[slots])
+            header['chunks'] = [c for c in header['chunks'] if c['name'] != name] + [dict(name=name, start=int(start), end=int(written))]
+        # 새 row로 전부 덮어써진 chunk는 지움
+        stale = [c for c in header['chunks'] if c['end'] <= written - self.size]
+        header['chunks'] = [c for c in header['chunks'] if c['end'] > written - self.size]
+        # compact에서 마지막 row는 다음 transition이 다시 쓰므로 다음 snapshot에 다시 포함
+        header['saved_rows'] = int(self.num_rows if self.compact else written)
+        header.update(num_experience=int(self.num_experience), ring_pos=int(written%self.size), size=self.size, compact=self.compact, storage=self.storage,
+                      max_quantization_error=self.max_quantization_error, tags=tags)
+        if self.compact:
+            header.update(num_rows=int(self.num_rows), pending=bool(self.pending))
+        if self.sampler is not None:
+            # priority는 예전 row도 계속 바뀌므로 chunk가 아니라 전체를 매번 (float32, 1M row에 4MB)
+            np.save(os.path.join(path, 'priority.tmp.npy'), self.sampler.tree.get(np.arange(self.filled_rows())).astype(np.float32))
+            os.replace(os.path.join(path, 'priority.tmp.npy'), os.path.join(path, 'priority.npy'))
+            header['max_priority'] = float(self.sampler.max_priority)
+        with open(header_file + '.tmp', 'w') as f:
+            json.dump(header, f)
+        os.replace(header_file + '.tmp', header_file)
+        for c in stale:
+            shutil.rmtree(os.path.join(path, c['name']), ignore_errors=True)
+    def load_snapshot(self,path):
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        assert header['size'] == self.size and header['compact'] == self.compact and header.get('storage', 'float32') == self.storage
+        fields = self.snapshot_fields()
+        for c in header['chunks']:
+            chunk_dir = os.path.join(path, c['name'])
+            for key, mem in fields.items():
+                self.ring_write(mem, c['start'], np.load(os.path.join(chunk_dir, key + '.npy'), mmap_mode='r'))
+        self.num_experience = header['num_experience']
+        self.max_quantization_error.update(header.get('max_quantization_error', {}))
+        if self.compact:
+            self.num_rows, self.pending = header['num_rows'], header['pending']
+        if self.sampler is not None:
+            priority = np.load(os.path.join(path, 'priority.npy'), mmap_mode='r')
+            self.sampler.tree.update(np.arange(len(priority)), priority)
+            self.sampler.max_priority = header['max_priority']
+        return header
+    def store_dataset(self,dataset,storage='float32'):
+        # d4rl_dataset.dataset 같은 dict (observations, actions, rewards, next_observations, dones)를 한번에.
+        # storage: dataset의 obs/action 저장 형식 (d4rl_dataset(storage=...)). float32로 decode한 뒤 store_batch가 buffer 형식으로 encode
+        fields = [dataset[key] for key in ('observations', 'actions', 'next_observations')]
+        if any(np.asarray(x).dtype != storage_dtype(storage) for x in fields):
+            raise ValueError("dataset obs/action dtype %s does not match storage %s" % (np.asarray(fields[0]).dtype, storage))
+        o, a, no = (decode(x, storage) for x in fields)
+        self.store_batch(o, a, dataset['rewards'], no, np.asarray(dataset['dones'], dtype=np.float32))
+    def filled_rows(self):
+        if self.compact:
+            return min(self.num_rows + int(self.pending), self.size)
+        return min(self.num_experience, self.size)
+    def sample_idx(self, batch_size):
+        N = self.filled_rows()
         idx = np.random.choice(N,batch_size)
-        o_batch = self.o_mem[idx]
-        a_batch = self.a_mem[idx]
+        if self.compact:
+            # next obs만 있는 row는 다시 뽑음 (episode 당 1 row라 거의 안 걸림)
+            invalid = ~self.valid_mem[idx]
+            while invalid.any():
+                idx[invalid] = np.random.choice(N, int(invalid.sum()))
+                invalid = ~self.valid_mem[idx]
+        return idx
+    def next_obs(self, idx):
+        if self.compact:
+            return self.o_mem[(idx+1)%self.size]
+        return self.no_mem[idx]
+    def gather(self, idx):
+        # 저장 형식에 상관없이 float32 batch로
+        o_batch = decode(self.o_mem[idx], self.storage)
+        a_batch = decode(self.a_mem[idx], self.storage)
         r_batch = self.r_mem[idx]
-        no_batch = self.no_mem[idx]
-        done_batch = self.done_mem[idx]
+        no_batch = decode(self.next_obs(idx), self.storage)
+        done_batch = np.asarray(self.done_mem[idx], dtype=np.float32)
         return o_batch, a_batch, r_batch, no_batch, done_batch
+    def random_batch(self, batch_size = 256):
+        if self.sampler is not None:
+            return self.prioritized_batch(batch_size)
+        idx = self.sample_idx(batch_size)
+        return self.gather(idx)
+    def prioritized_batch(self, batch_size = 256):
+        idx, weights = self.sampler.sample(batch_size, self.filled_rows())
+        extras = dict(idx=idx, weights=weights, update_priorities=self.update_priorities)
+        return self.gather(idx) + (extras,)
+    def update_priorities(self, idx, priorities):
+        self.sampler.update(idx, priorities)
     def all_batch(self):
-        N = min(self.num_experience,self.size)
-        return self.o_mem[:N], self.a_mem[:N], self.r_mem[:N], self.no_mem[:N], self.done_mem[:N]
+        N = self.filled_rows()
+        if self.compact:
+            return self.gather(np.flatnonzero(self.valid_mem[:N]))
+        return self.gather(slice(0, N))
     def store_demo(self,demo):
         demo_len= len(demo)-1
-        self.o_mem[:demo_len]  = demo[:-1]
-        self.no_mem[:demo_len] = demo[1:]
+        demo = encode(demo, self.storage)
+        if self.compact:
+            self.o_mem[:demo_len+1] = demo
+            self.valid_mem[:demo_len] = True
+            self.valid_mem[demo_len] = False
+            self.num_rows += demo_len
+            self.pending = True
+        else:
+            self.o_mem[:demo_len]  = demo[:-1]
+            self.no_mem[:demo_len] = demo[1:]
+        if self.sampler is not None:
+            self.sampler.add(np.arange(demo_len))
         self.num_experience += demo_len
 
 
 
+class InferencePolicy:
+    # select_action용 policy 복사본: device_eval에 두고 obs 하나를 inference_mode로 (numpy in / numpy out, float32).
+    # module 호출 없이 미리 잡아둔 obs / hidden / action buffer에 addmm(out=)으로. 반환은 호출마다 새 array (buffer의 copy).
+    # training policy parameter가 바뀌었으면 (optimizer step, load_state_dict -> version counter) 호출할 때 복사
+    def __init__(self, policy, device='cpu'):
+        self.source = policy
+        self.source_params = list(policy.parameters())
+        self.device = torch.device(device)
+        self.policy = flatten_parameters(deepcopy(policy).to(self.device))
+        self.policy.requires_grad_(False)
+        self.stochastic = isinstance(policy, Policy)
+        fc1, fc2 = self.policy.fc1, self.policy.fc2
+        fc3 = self.policy.fc3_mu if self.stochastic else self.policy.fc3
+        # (weight^T view, bias, out buffer)
+        self.layers = [(layer.weight.t(), layer.bias, torch.zeros((1, layer.out_features), device=self.device)) for layer in (fc1, fc2, fc3)]
+        if self.stochastic:
+            self.log_sigma_layer = (self.policy.fc3_log_sigma.weight.t(), self.policy.fc3_log_sigma.bias, torch.zeros((1, fc3.out_features), device=self.device))
+        pin_memory = self.device.type == 'cuda'
+        self.o_host = torch.zeros((1, fc1.in_features), pin_memory=pin_memory)
+        self.a_host = torch.zeros((1, fc3.out_features), pin_memory=pin_memory)
+        self.o_numpy, self.a_numpy = self.o_host.numpy(), self.a_host.numpy()[0]
+        self.o_device = self.o_host if self.device.type == 'cpu' else torch.zeros((1, fc1.in_features), device=self.device)
+        self.version = None
+
+    def sync(self):
+        # parameter마다 version counter (flat buffer의 view지만 .data로 만든 view라 counter는 따로)
+        version = tuple([p._version for p in self.source_params])
+        if version != self.version:
+            with torch.no_grad():
+                hard_update(self.policy, self.source)
+            self.version = version
+
+    def __call__(self, o, eval=True):
+        self.sync()
+        np.copyto(self.o_numpy, np.reshape(o, self.o_numpy.shape))
+        with torch.inference_mode():
+            if self.o_device is not self.o_host:
+                self.o_device.copy_(self.o_host, non_blocking=True)
+            x = self.o_device
+            for n, (weight, bias, out) in enumerate(self.layers):
+                x = torch.addmm(bias, x, weight, out=out)
+                if n < 2:
+                    x.relu_()
+            if self.stochastic and not eval:
+                weight, bias, log_sigma = self.log_sigma_layer
+                torch.addmm(bias, self.layers[1][2], weight, out=log_sigma)
+                log_sigma.clamp_(self.policy.LOG_SIG_MIN, self.policy.LOG_SIG_MAX).exp_()
+                x.addcmul_(log_sigma, torch.randn_like(log_sigma))
+            self.a_host.copy_(x.tanh_())
+        return self.a_numpy.copy()
+
 class SAC_Agent:
     def __init__(self,o_dim,a_dim,args):
         self.o_dim, self.a_dim = o_dim, a_dim
@@ -66,82 +433,84 @@ class SAC_Agent:
         self.lr = args.SAC_lr
 
         #Define networks
-        self.q1 = Qnet(self.o_dim, self.a_dim, self.hidden_size).to(args.device_train)
-        self.q2 = Qnet(self.o_dim, self.a_dim, self.hidden_size).to(args.device_train)
-        self.target_q1 = deepcopy(self.q1)
-        self.target_q2 = deepcopy(self.q2)
-        self.pi = Policy(self.o_dim, self.a_dim,self.hidden_size).to(args.device_train)
-        self.buffer = Buffer(o_dim, a_dim)
+        self.q = flatten_parameters(EnsembleQnet(self.o_dim, self.a_dim, self.hidden_size, args.critic_ensemble_size).to(args.device_train))
+        self.target_q = target_copy(self.q)
+        self.pi = flatten_parameters(Policy(self.o_dim, self.a_dim,self.hidden_size).to(args.device_train))
+        self.buffer = Buffer(o_dim, a_dim, compact=args.compact_buffer, prioritized=args.prioritized, storage=args.storage)
 
         self.log_alpha = torch.tensor(0.0,requires_grad=True,device=args.device_train)
         #Define optimizer
-        self.q1_opt = torch.optim.Adam(self.q1.parameters(), lr=self.lr)
-        self.q2_opt = torch.optim.Adam(self.q2.parameters(), lr=self.lr)
+        self.q_opt = torch.optim.Adam(self.q.parameters(), lr=self.lr)
         self.pi_opt = torch.optim.Adam(self.pi.parameters(), lr=self.lr)
         self.alpha_opt = torch.optim.Adam([self.log_alpha], lr=self.lr)
+        set_autocast(args.autocast, self.q, self.target_q, self.pi)
+        compile_update(self, ('q_train', 'pi_train', 'alpha_train'), args.compile)
+        self.inference_pi = InferencePolicy(self.pi, args.device_eval)
 
 
     def select_action(self,o,eval=False):
-        action, _ = self.pi(torch.FloatTensor(o).to(self.args.device_train), eval)
-        return action.cpu().detach().numpy()[0]
+        return self.inference_pi(o, eval)
 
     def store_sample(self,o,a,r,no,done):
         self.buffer.store_sample(o,a,r,no,done)
 
     def train(self):
         if self.buffer.num_experience >= self.training_start:
-            state_batch, action_batch, reward_batch, next_state_batch, done_batch = self.buffer.random_batch(self.args.SAC_batch_size)
+            (state_batch, action_batch, reward_batch, next_state_batch, done_batch), extras = unpack_batch(self.buffer.random_batch(self.args.SAC_batch_size))
 
-            state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-            action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
-            reward_batch = torch.FloatTensor(reward_batch).to(self.args.device_train)
-            next_state_batch = torch.FloatTensor(next_state_batch).to(self.args.device_train)
-            done_batch = torch.FloatTensor(done_batch).to(self.args.device_train)
+            state_batch = to_tensor(state_batch, self.args.device_train)
+            action_batch = to_tensor(action_batch, self.args.device_train)
+            reward_batch = to_tensor(reward_batch, self.args.device_train).reshape(state_batch.shape[0])
+            next_state_batch = to_tensor(next_state_batch, self.args.device_train)
+            done_batch = to_tensor(done_batch, self.args.device_train).reshape(state_batch.shape[0])
 
-            self.q_train(state_batch, action_batch,reward_batch,next_state_batch,done_batch)
-            self.pi_train(state_batch)
-            self.alpha_train(state_batch)
-            self.target_q_update()
+            self.update(state_batch, action_batch,reward_batch,next_state_batch,done_batch, extras)
 
     def train_off(self, batch):
-        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch
+        (state_batch, action_batch, reward_batch, next_state_batch, done_batch), extras = unpack_batch(batch)
+
+        state_batch = to_tensor(state_batch, self.args.device_train)
+        action_batch = to_tensor(action_batch, self.args.device_train)
+        reward_batch = to_tensor(reward_batch, self.args.device_train)
+        next_state_batch = to_tensor(next_state_batch, self.args.device_train)
+        done_batch = to_tensor(done_batch, self.args.device_train)
 
-        state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-        action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
-        reward_batch = torch.FloatTensor(reward_batch).to(self.args.device_train)
-        next_state_batch = torch.FloatTensor(next_state_batch).to(self.args.device_train)
-        done_batch = torch.FloatTensor(done_batch).to(self.args.device_train)
+        return self.update(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras)
 
-        self.q_train(state_batch, action_batch, reward_batch, next_state_batch, done_batch)
-        self.pi_train(state_batch)
-        self.alpha_train(state_batch)
+    def train_many(self, batches, num_steps=None):
+        # (K, B, ...) batch (stack_batches) 또는 sampler로 K번 update, loss 평균 반환
+        return run_updates(self.update, batches, self.args.device_train, num_steps)
+
+    def update(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None):
+        q_loss = self.q_train(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras)
+        pi_loss = self.pi_train(state_batch)
+        alpha_loss = self.alpha_train(state_batch)
         self.target_q_update()
+        return dict(q_loss=q_loss, pi_loss=pi_loss, alpha_loss=alpha_loss)
 
-    def q_train(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch):
-        self.q1_opt.zero_grad()
-        self.q2_opt.zero_grad()
-        q_val1,q_val2 = self.q1(state_batch,action_batch), self.q2(state_batch,action_batch)
+    def q_train(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None):
+        self.q_opt.zero_grad()
+        q_vals = self.q(state_batch,action_batch)
         with torch.no_grad():
             next_action_batch, next_log_pi = self.pi(next_state_batch)
-            next_q_val1, next_q_val2 = self.target_q1(next_state_batch,next_action_batch), self.target_q2(next_state_batch,next_action_batch)
-            minq = torch.min(next_q_val1,next_q_val2)
-            target_ = reward_batch + self.gamma*(1-done_batch)*(minq - torch.exp(self.log_alpha)*next_log_pi)
+            minq = self.target_q(next_state_batch,next_action_batch).min(0)[0]
+            target_ = reward_batch + td_discount(extras, self.gamma, done_batch, self.args.device_train)*(minq - torch.exp(self.log_alpha)*next_log_pi)
 
-        q1_loss = F.mse_loss(target_,q_val1)
-        q2_loss = F.mse_loss(target_,q_val2)
+        weights = batch_weights(extras, self.args.device_train)
+        q_loss = td_loss(target_,q_vals,weights)
+        update_priorities(extras, target_, q_vals)
 
-        q_loss = q1_loss + q2_loss
         q_loss.backward()
-        self.q1_opt.step()
-        self.q2_opt.step()
+        self.q_opt.step()
+        return q_loss.detach()
 
     def pi_train(self,state_batch):
         self.pi_opt.zero_grad()
         action, log_pi = self.pi(state_batch)
-        q_val1, q_val2 = self.q1(state_batch,action), self.q2(state_batch,action)
-        pi_loss = (torch.exp(self.log_alpha)*log_pi - torch.min(q_val1,q_val2)).mean()
+        pi_loss = (torch.exp(self.log_alpha)*log_pi - self.q(state_batch,action).min(0)[0]).mean()
         pi_loss.backward()
         self.pi_opt.step()
+        return pi_loss.detach()
 
     def alpha_train(self,state_batch):
         self.alpha_opt.zero_grad()
@@ -150,13 +519,11 @@ class SAC_Agent:
         alpha_loss = (torch.exp(self.log_alpha)*(-log_pi - target_entropy)).mean()
         alpha_loss.backward()
         self.alpha_opt.step()
+        return alpha_loss.detach()
 
     def target_q_update(self):
         with torch.no_grad():
-            for target_param, param in zip(self.target_q1.parameters(), self.q1.parameters()):
-                target_param.data.copy_(target_param.data * (1.0 - self.args.SAC_tau) + param.data * self.args.SAC_tau)
-            for target_param, param in zip(self.target_q2.parameters(), self.q2.parameters()):
-                target_param.data.copy_(target_param.data * (1.0 - self.args.SAC_tau) + param.data * self.args.SAC_tau)
+            soft_update(self.target_q, self.q, self.args.SAC_tau)
 
 class SAC_CQL_Agent:
     def __init__(self,o_dim,a_dim,args):
@@ -183,11 +550,9 @@ class SAC_CQL_Agent:
 
 
         #Define networks
-        self.q1 = Qnet(self.o_dim, self.a_dim, self.hidden_size).to(args.device_train)
-        self.q2 = Qnet(self.o_dim, self.a_dim, self.hidden_size).to(args.device_train)
-        self.target_q1 = deepcopy(self.q1)
-        self.target_q2 = deepcopy(self.q2)
-        self.pi = Policy(self.o_dim, self.a_dim,self.hidden_size).to(args.device_train)
+        self.q = flatten_parameters(EnsembleQnet(self.o_dim, self.a_dim, self.hidden_size, args.critic_ensemble_size).to(args.device_train))
+        self.target_q = target_copy(self.q)
+        self.pi = flatten_parameters(Policy(self.o_dim, self.a_dim,self.hidden_size).to(args.device_train))
 
         self.log_alpha = torch.tensor(0.0,requires_grad=True,device=args.device_train)
 
@@ -195,158 +560,150 @@ class SAC_CQL_Agent:
         self.log_alpha_prime = torch.tensor(1.0, requires_grad=True, device=args.device_train)
 
         #Define optimizer
-        self.q1_opt = torch.optim.Adam(self.q1.parameters(), lr=self.lr)
-        self.q2_opt = torch.optim.Adam(self.q2.parameters(), lr=self.lr)
+        # CQL Lagrange multiplier도 critic과 같은 optimizer로 (backward 한번, step 한번)
+        self.q_opt = torch.optim.Adam([{'params': self.q.parameters()}, {'params': [self.log_alpha_prime]}], lr=self.lr)
         self.pi_opt = torch.optim.Adam(self.pi.parameters(), lr=self.lr)
         self.alpha_opt = torch.optim.Adam([self.log_alpha], lr=self.lr)
-        self.alpha_prime_opt = torch.optim.Adam([self.log_alpha_prime], lr=self.lr)
+        set_autocast(args.autocast, self.q, self.target_q, self.pi)
+        # pi, q, alpha loss가 한 compiled graph에 같이 있으면 backward를 loss마다 따로 못하므로 loss 단위로 compile.
+        # 이렇게 잘게 compile하면 오히려 느려서 (benchmark compile: eager 10.0 -> 8.9 steps/s) --compile만으로는 안하고 --compile_sac_cql일 때만
+        compile_update(self, ('policy_samples', 'get_pi_loss', 'get_q_loss', 'get_alpha_loss'), args.compile_sac_cql)
+        self.inference_pi = InferencePolicy(self.pi, args.device_eval)
 
 
     def select_action(self,o,eval=False):
-        action, _ = self.pi(torch.FloatTensor(o).to(self.args.device_train), eval)
-        return action.cpu().detach().numpy()[0]
+        return self.inference_pi(o, eval)
 
     def store_sample(self,o,a,r,no,done):
         self.buffer.store_sample(o,a,r,no,done)
 
     def train(self,batch):
-        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch
+        (state_batch, action_batch, reward_batch, next_state_batch, done_batch), extras = unpack_batch(batch)
 
 
-        state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-        action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
-        reward_batch = torch.FloatTensor(reward_batch).to(self.args.device_train)
-        next_state_batch = torch.FloatTensor(next_state_batch).to(self.args.device_train)
-        done_batch = torch.FloatTensor(done_batch).to(self.args.device_train)
+        state_batch = to_tensor(state_batch, self.args.device_train)
+        action_batch = to_tensor(action_batch, self.args.device_train)
+        reward_batch = to_tensor(reward_batch, self.args.device_train)
+        next_state_batch = to_tensor(next_state_batch, self.args.device_train)
+        done_batch = to_tensor(done_batch, self.args.device_train)
+        return self.update(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras)
 
+    def train_many(self, batches, num_steps=None):
+        # (K, B, ...) batch (stack_batches) 또는 sampler로 K번 update, loss 평균 반환
+        return run_updates(self.update, batches, self.args.device_train, num_steps)
 
-        pi_loss    = self.get_pi_loss(state_batch)
-        q1_loss, q2_loss     = self.get_q_loss(state_batch, action_batch,reward_batch,next_state_batch,done_batch)
-        alpha_loss = self.get_alpha_loss(state_batch)
+    def update(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None):
+        samples    = self.policy_samples(state_batch, next_state_batch)
+        actions, log_pis = samples[0][:, 0], samples[1][:, 0]
+        pi_loss    = self.get_pi_loss(state_batch, actions, log_pis)
+        q_loss     = self.get_q_loss(state_batch, action_batch,reward_batch,next_state_batch,done_batch, extras, samples)
+        alpha_loss = self.get_alpha_loss(state_batch, log_pis)
 
+        # backward를 다 끝낸 다음 step (step이 다른 loss의 backward에 필요한 값을 in-place로 바꾸지 않도록)
         self.alpha_opt.zero_grad()
         alpha_loss.backward()
-        self.alpha_opt.step()
-
         self.pi_opt.zero_grad()
         pi_loss.backward()
-        self.pi_opt.step()
-
-        self.q1_opt.zero_grad()
-        q1_loss.backward(retain_graph=True)
-        self.q1_opt.step()
+        self.q_opt.zero_grad()
+        q_loss.backward()
 
-        self.q2_opt.zero_grad()
-        q2_loss.backward()
-        self.q2_opt.step()
+        self.alpha_opt.step()
+        self.pi_opt.step()
+        self.q_opt.step()
 
 
         self.target_q_update()
+        return dict(q_loss=q_loss.detach(), pi_loss=pi_loss.detach(), alpha_loss=alpha_loss.detach())
 
 
-    def get_q_loss(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch):
-        q_val1,q_val2 = self.q1(state_batch,action_batch), self.q2(state_batch,action_batch)
-
-        next_action_batch, next_log_pi = self.pi(next_state_batch)
-        next_q_val1, next_q_val2 = self.target_q1(next_state_batch,next_action_batch), self.target_q2(next_state_batch,next_action_batch)
-        minq = torch.min(next_q_val1,next_q_val2)
-        if self.backup_entropy:
-            target_ = reward_batch + self.gamma * (1 - done_batch) * (minq - torch.exp(self.log_alpha)*next_log_pi)
-        else:
-            target_ = reward_batch + self.gamma * (1 - done_batch) * (minq)
-
-        q1_loss = F.mse_loss(target_.detach(),q_val1)
-        q2_loss = F.mse_loss(target_.detach(),q_val2)
-
-
-        #====여까지는 그냥 SAC랑 같음
+    def policy_samples(self,state_batch,next_state_batch):
+        # state, next_state마다 policy forward 한번씩 (repeat=N+1).
+        # [:, 0]은 actor/alpha loss와 TD target, [:, 1:]은 CQL action으로 씀 -> (B, N+1, a_dim), (B, N+1)
+        actions, log_pis = self.pi(state_batch, repeat=self.cql_n_actions + 1)
+        with torch.no_grad():
+            # next_state 쪽은 target과 CQL에서 모두 detach해서 쓰므로 graph 필요 없음
+            next_actions, next_log_pis = self.pi(next_state_batch, repeat=self.cql_n_actions + 1)
+        return actions, log_pis, next_actions, next_log_pis
+
+    def get_q_loss(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None,samples=None):
+        if samples is None:
+            samples = self.policy_samples(state_batch, next_state_batch)
+        actions, log_pis, next_actions, next_log_pis = samples
         batch_size = action_batch.shape[0]
         action_dim = action_batch.shape[-1]
         cql_random_actions = action_batch.new_empty((batch_size, self.cql_n_actions, action_dim),requires_grad=False).uniform_(-1, 1)
 
 
-        cql_current_actions, cql_current_log_pis = self.pi(state_batch, repeat=self.cql_n_actions)
-        cql_next_actions, cql_next_log_pis = self.pi(next_state_batch, repeat=self.cql_n_actions)
-        cql_current_actions, cql_current_log_pis = cql_current_actions.detach(), cql_current_log_pis.detach()
-        cql_next_actions, cql_next_log_pis = cql_next_actions.detach(), cql_next_log_pis.detach()
+        cql_current_actions, cql_current_log_pis = actions[:, 1:].detach(), log_pis[:, 1:].detach()
+        cql_next_actions, cql_next_log_pis = next_actions[:, 1:], next_log_pis[:, 1:]
 
+        q_vals, cql_q_rand, cql_q_current_actions, cql_q_next_actions = cql_q_values(
+            self.q, state_batch, action_batch, cql_random_actions, cql_current_actions, cql_next_actions)
 
-        cql_q1_rand = self.q1(state_batch, cql_random_actions)
-        cql_q2_rand = self.q2(state_batch, cql_random_actions)
-        cql_q1_current_actions = self.q1(state_batch, cql_current_actions)
-        cql_q2_current_actions = self.q2(state_batch, cql_current_actions)
-        cql_q1_next_actions = self.q1(state_batch, cql_next_actions)
-        cql_q2_next_actions = self.q2(state_batch , cql_next_actions)
+        next_action_batch, next_log_pi = next_actions[:, 0], next_log_pis[:, 0]
+        minq = self.target_q(next_state_batch,next_action_batch).min(0)[0]
+        discount = td_discount(extras, self.gamma, done_batch, self.args.device_train)
+        if self.backup_entropy:
+            target_ = reward_batch + discount * (minq - torch.exp(self.log_alpha)*next_log_pi)
+        else:
+            target_ = reward_batch + discount * (minq)
 
-        cql_cat_q1 = torch.cat(
-            [cql_q1_rand, torch.unsqueeze(q_val1, 1), cql_q1_next_actions, cql_q1_current_actions], dim=1
-        )
-        cql_cat_q2 = torch.cat(
-            [cql_q2_rand, torch.unsqueeze(q_val2, 1), cql_q2_next_actions, cql_q2_current_actions], dim=1
+        weights = batch_weights(extras, self.args.device_train)
+        q_loss = td_loss(target_.detach(),q_vals,weights)
+        update_priorities(extras, target_, q_vals)
+
+
+        #====여까지는 그냥 SAC랑 같음
+        cql_cat_q = torch.cat(
+            [cql_q_rand, torch.unsqueeze(q_vals, -1), cql_q_next_actions, cql_q_current_actions], dim=-1
         )
-        # cql_std_q1 = torch.std(cql_cat_q1, dim=1)
-        # cql_std_q2 = torch.std(cql_cat_q2, dim=1)
+        # cql_std_q = torch.std(cql_cat_q, dim=-1)
 
         if self.cql_importance_sample:
             random_density = np.log(0.5 ** action_dim)
-            cql_cat_q1 = torch.cat(
-                [cql_q1_rand - random_density,
-                 cql_q1_next_actions - cql_next_log_pis.detach(),
-                 cql_q1_current_actions - cql_current_log_pis.detach()],
-                dim=1
-            )
-            cql_cat_q2 = torch.cat(
-                [cql_q2_rand - random_density,
-                 cql_q2_next_actions - cql_next_log_pis.detach(),
-                 cql_q2_current_actions - cql_current_log_pis.detach()],
-                dim=1
+            cql_cat_q = torch.cat(
+                [cql_q_rand - random_density,
+                 cql_q_next_actions - cql_next_log_pis.detach(),
+                 cql_q_current_actions - cql_current_log_pis.detach()],
+                dim=-1
             )
 
-        cql_qf1_ood = torch.logsumexp(cql_cat_q1 / self.cql_temp, dim=1) * self.cql_temp
-        cql_qf2_ood = torch.logsumexp(cql_cat_q2 / self.cql_temp, dim=1) * self.cql_temp
+        cql_qf_ood = torch.logsumexp(cql_cat_q / self.cql_temp, dim=-1) * self.cql_temp
 
         """Subtract the log likelihood of data"""
-        cql_qf1_diff = torch.clamp(
-            cql_qf1_ood - q_val1,
+        # member별 (E,)
+        cql_qf_diff = torch.clamp(
+            cql_qf_ood - q_vals,
             self.cql_clip_diff_min,
             self.cql_clip_diff_max,
-        ).mean()
-        cql_qf2_diff = torch.clamp(
-            cql_qf2_ood - q_val2,
-            self.cql_clip_diff_min,
-            self.cql_clip_diff_max,
-        ).mean()
+        ).mean(-1)
 
 
         if self.cql_lagrange:
             alpha_prime = torch.clamp(torch.exp(self.log_alpha_prime), min=0.0, max=1000000.0)
-            cql_min_qf1_loss = alpha_prime * self.cql_min_q_weight * (
-                        cql_qf1_diff - self.cql_target_action_gap)
-            cql_min_qf2_loss = alpha_prime * self.cql_min_q_weight * (
-                        cql_qf2_diff - self.cql_target_action_gap)
-
-            self.alpha_prime_opt.zero_grad()
-            alpha_prime_loss = (-cql_min_qf1_loss - cql_min_qf2_loss) * 0.5
-            alpha_prime_loss.backward(retain_graph=True)
-            self.alpha_prime_opt.step()
+            # critic은 alpha_prime을, alpha_prime은 cql diff를 상수로 -> 두 loss를 더해서 backward 한번
+            cql_min_qf_loss = alpha_prime.detach() * self.cql_min_q_weight * (
+                        cql_qf_diff - self.cql_target_action_gap)
+            alpha_prime_loss = -(alpha_prime * self.cql_min_q_weight * (
+                        cql_qf_diff.detach() - self.cql_target_action_gap)).mean()
         else:
-            cql_min_qf1_loss = cql_qf1_diff * self.cql_min_q_weight
-            cql_min_qf2_loss = cql_qf2_diff * self.cql_min_q_weight
+            cql_min_qf_loss = cql_qf_diff * self.cql_min_q_weight
+            alpha_prime_loss = 0.0
 
-        q1_loss_add_cql =  q1_loss + cql_min_qf1_loss
-        q2_loss_add_cql =  q2_loss + cql_min_qf2_loss
+        q_loss_add_cql =  q_loss + cql_min_qf_loss.sum() + alpha_prime_loss
 
-        return q1_loss_add_cql, q2_loss_add_cql
+        return q_loss_add_cql
 
 
-    def get_pi_loss(self,state_batch):
-        action, log_pi = self.pi(state_batch)
-        q_val1, q_val2 = self.q1(state_batch,action), self.q2(state_batch,action)
-        pi_loss = (torch.exp(self.log_alpha)*log_pi - torch.min(q_val1,q_val2)).mean()
+    def get_pi_loss(self,state_batch,action=None,log_pi=None):
+        if action is None:
+            action, log_pi = self.pi(state_batch)
+        pi_loss = (torch.exp(self.log_alpha).detach()*log_pi - self.q(state_batch,action).min(0)[0]).mean()
         return pi_loss
 
-    def get_alpha_loss(self,state_batch):
-        _, log_pi = self.pi(state_batch)
+    def get_alpha_loss(self,state_batch,log_pi=None):
+        if log_pi is None:
+            _, log_pi = self.pi(state_batch)
         target_entropy = -self.a_dim
         alpha_loss = (torch.exp(self.log_alpha)*(-log_pi - target_entropy).detach()).mean()
         return  alpha_loss
@@ -354,10 +711,7 @@ class SAC_CQL_Agent:
 
     def target_q_update(self):
         with torch.no_grad():
-            for target_param, param in zip(self.target_q1.parameters(), self.q1.parameters()):
-                target_param.data.copy_(target_param.data * (1.0 - self.args.SAC_tau) + param.data * self.args.SAC_tau)
-            for target_param, param in zip(self.target_q2.parameters(), self.q2.parameters()):
-                target_param.data.copy_(target_param.data * (1.0 - self.args.SAC_tau) + param.data * self.args.SAC_tau)
+            soft_update(self.target_q, self.q, self.args.SAC_tau)
 
 
 
@@ -376,18 +730,19 @@ class TD3_Agent:
         self.update_count = 0
 
         #Define networks
-        self.q1 = Qnet(self.o_dim, self.a_dim, self.hidden_size).to(args.device_train)
-        self.q2 = Qnet(self.o_dim, self.a_dim, self.hidden_size).to(args.device_train)
-        self.target_q1 = deepcopy(self.q1)
-        self.target_q2 = deepcopy(self.q2)
+        self.q = flatten_parameters(EnsembleQnet(self.o_dim, self.a_dim, self.hidden_size, args.critic_ensemble_size).to(args.device_train))
+        self.target_q = target_copy(self.q)
 
-        self.pi = Det_Policy(self.o_dim, self.a_dim,self.hidden_size).to(args.device_train)
-        self.target_pi = deepcopy(self.pi)
-        self.buffer = Buffer(o_dim, a_dim)
+        self.pi = flatten_parameters(Det_Policy(self.o_dim, self.a_dim,self.hidden_size).to(args.device_train))
+        self.target_pi = target_copy(self.pi)
+        self.buffer = Buffer(o_dim, a_dim, compact=args.compact_buffer, prioritized=args.prioritized, storage=args.storage)
+
+        #Define CQL value
+        self.log_alpha_prime = torch.tensor(1.0, requires_grad=True, device=args.device_train)
 
         #Define optimizer
-        self.q1_opt = torch.optim.Adam(self.q1.parameters(), lr=self.lr)
-        self.q2_opt = torch.optim.Adam(self.q2.parameters(), lr=self.lr)
+        # CQL Lagrange multiplier도 critic과 같은 optimizer로 (backward 한번, step 한번)
+        self.q_opt = torch.optim.Adam([{'params': self.q.parameters()}, {'params': [self.log_alpha_prime]}], lr=self.lr)
         self.pi_opt = torch.optim.Adam(self.pi.parameters(), lr=self.lr)
         #====cql hyper====
         # CQL Hyperparmeters===나중에 args로 바꿔줘야함
@@ -401,65 +756,95 @@ class TD3_Agent:
         self.cql_max_target_backup = False
         self.cql_clip_diff_min = -np.inf
         self.cql_clip_diff_max =  np.inf
+        set_autocast(args.autocast, self.q, self.target_q, self.pi, self.target_pi)
+        compile_update(self, ('q_train', 'q_train_cql', 'pi_train'), args.compile)
+        self.inference_pi = InferencePolicy(self.pi, args.device_eval)
 
     def init_pi(self,dir):
         self.pi.load_state_dict(torch.load(dir)['policy'])
-        self.target_pi = deepcopy(self.pi)
+        self.target_pi = target_copy(self.pi)
     def init_q(self,dir):
-        self.q1.load_state_dict(torch.load(dir)['q1'])
-        self.q2.load_state_dict(torch.load(dir)['q2'])
-        self.target_q1 = deepcopy(self.q1)
-        self.target_q2 = deepcopy(self.q2)
+        # checkpoint는 Qnet 두개 ('q1', 'q2') 형식 그대로라 critic_ensemble_size 2일 때만
+        assert self.q.ensemble_size == 2, "init_q checkpoint has 2 critics (q1, q2), got critic_ensemble_size %d" % self.q.ensemble_size
+        checkpoint = torch.load(dir)
+        self.q.load_qnet_state_dicts([checkpoint['q1'], checkpoint['q2']])
+        self.target_q = target_copy(self.q)
+
+    def save_checkpoint(self,path,**extra):
+        # run 이어하기용: network, target, optimizer, update_count (+ script의 episode_step 등은 extra로)
+        checkpoint = dict(pi=self.pi.state_dict(), q=self.q.state_dict(),
+                          target_pi=self.target_pi.state_dict(), target_q=self.target_q.state_dict(),
+                          pi_opt=self.pi_opt.state_dict(), q_opt=self.q_opt.state_dict(),
+                          log_alpha_prime=self.log_alpha_prime.detach(), update_count=self.update_count, **extra)
+        torch.save(checkpoint, path + '.tmp')
+        os.replace(path + '.tmp', path)
+    def load_checkpoint(self,path,**expect):
+        # load_state_dict는 in-place copy라 flat parameter view가 유지됨.
+        # expect의 값 (update_count, episode_step 등)이 checkpoint와 다르면 아무것도 바꾸지 않고 ValueError
+        checkpoint = torch.load(path, map_location=self.args.device_train)
+        mismatch = {key: (checkpoint.get(key), value) for key, value in expect.items() if checkpoint.get(key) != value}
+        if mismatch:
+            raise ValueError("checkpoint %s does not match (checkpoint, expected): %s" % (path, mismatch))
+        for name in ('pi', 'q', 'target_pi', 'target_q', 'pi_opt', 'q_opt'):
+            getattr(self, name).load_state_dict(checkpoint[name])
+        with torch.no_grad():
+            self.log_alpha_prime.copy_(checkpoint['log_alpha_prime'])
+        self.update_count = checkpoint['update_count']
+        return checkpoint
 
     def select_action(self,o,eval=False):
-        o = o.reshape([1,-1])
+        action = self.inference_pi(o)
         if eval:
-            action = self.pi(torch.FloatTensor(o).to(self.args.device_train))
-            return  action.cpu().detach().numpy()[0]
-        else:
-            action = (self.pi(torch.FloatTensor(o).to(self.args.device_train)).cpu().detach().numpy()[0] + \
-                     + 0.1 * np.random.normal(0.0, 1.0, [self.a_dim])).clip(-1.0,1.0)
             return action
+        return (action + 0.1 * np.random.normal(0.0, 1.0, [self.a_dim])).clip(-1.0,1.0)
 
     def store_sample(self,o,a,r,no,done):
         self.buffer.store_sample(o,a,r,no,done)
 
     def train(self):
         if self.buffer.num_experience >= self.training_start:
-            state_batch, action_batch, reward_batch, next_state_batch, done_batch = self.buffer.random_batch(self.args.SAC_batch_size)
+            (state_batch, action_batch, reward_batch, next_state_batch, done_batch), extras = unpack_batch(self.buffer.random_batch(self.args.SAC_batch_size))
 
-            state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-            action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
-            reward_batch = torch.FloatTensor(reward_batch).to(self.args.device_train).reshape(state_batch.shape[0])
-            next_state_batch = torch.FloatTensor(next_state_batch).to(self.args.device_train)
-            done_batch = torch.FloatTensor(done_batch).to(self.args.device_train).reshape(state_batch.shape[0])
+            state_batch = to_tensor(state_batch, self.args.device_train)
+            action_batch = to_tensor(action_batch, self.args.device_train)
+            reward_batch = to_tensor(reward_batch, self.args.device_train).reshape(state_batch.shape[0])
+            next_state_batch = to_tensor(next_state_batch, self.args.device_train)
+            done_batch = to_tensor(done_batch, self.args.device_train).reshape(state_batch.shape[0])
 
-            self.q_train(state_batch, action_batch,reward_batch,next_state_batch,done_batch)
+            self.q_train(state_batch, action_batch,reward_batch,next_state_batch,done_batch, extras)
 
             if (self.update_count%self.update_pi) == 0:
                 self.pi_train(state_batch)
                 with torch.no_grad():
-                    soft_update(self.target_q1, self.q1, self.tau)
-                    soft_update(self.target_q2, self.q2, self.tau)
+                    soft_update(self.target_q, self.q, self.tau)
                     soft_update(self.target_pi, self.pi, self.tau)
 
             self.update_count += 1
 
     def train_off(self, batch, cql=False):
-        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch
-
-        state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-        action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
-        reward_batch = torch.FloatTensor(reward_batch).to(self.args.device_train)
-        next_state_batch = torch.FloatTensor(next_state_batch).to(self.args.device_train)
-        done_batch = torch.FloatTensor(done_batch).to(self.args.device_train)
+        (state_batch, action_batch, reward_batch, next_state_batch, done_batch), extras = unpack_batch(batch)
+
+        state_batch = to_tensor(state_batch, self.args.device_train)
+        action_batch = to_tensor(action_batch, self.args.device_train)
+        reward_batch = to_tensor(reward_batch, self.args.device_train)
+        next_state_batch = to_tensor(next_state_batch, self.args.device_train)
+        done_batch = to_tensor(done_batch, self.args.device_train)
+        return self.update(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras, cql)
+
+    def train_many(self, batches, num_steps=None, cql=False):
+        # (K, B, ...) batch (stack_batches) 또는 sampler로 K번 train_off, loss 평균 반환
+        update_fn = lambda *batch: self.update(*batch, cql=cql)
+        return run_updates(update_fn, batches, self.args.device_train, num_steps)
+
+    def update(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None,cql=False):
+        losses = {}
         if cql:
-            self.q_train_cql(state_batch, action_batch, reward_batch, next_state_batch, done_batch)
+            losses['q_loss'] = self.q_train_cql(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras)
         else:
-            self.q_train(state_batch, action_batch, reward_batch, next_state_batch, done_batch)
+            losses['q_loss'] = self.q_train(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras)
 
         if (self.update_count % self.update_pi) == 0:
-            self.pi_train(state_batch)
+            losses['pi_loss'] = self.pi_train(state_batch)
             # with torch.no_grad():
             #     soft_update(self.target_q1, self.q1, self.tau)
             #     soft_update(self.target_q2, self.q2, self.tau)
@@ -467,73 +852,56 @@ class TD3_Agent:
 
         if (self.update_count % 2.0) == 0:
             with torch.no_grad():
-                soft_update(self.target_q1, self.q1, self.tau)
-                soft_update(self.target_q2, self.q2, self.tau)
+                soft_update(self.target_q, self.q, self.tau)
                 soft_update(self.target_pi, self.pi, self.tau)
 
         self.update_count += 1
+        return losses
 
     def train_Only_Q(self, batch,cql=False):
-        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch
+        (state_batch, action_batch, reward_batch, next_state_batch, done_batch), extras = unpack_batch(batch)
 
-        state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-        action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
-        reward_batch = torch.FloatTensor(reward_batch).to(self.args.device_train)
-        next_state_batch = torch.FloatTensor(next_state_batch).to(self.args.device_train)
-        done_batch = torch.FloatTensor(done_batch).to(self.args.device_train)
+        state_batch = to_tensor(state_batch, self.args.device_train)
+        action_batch = to_tensor(action_batch, self.args.device_train)
+        reward_batch = to_tensor(reward_batch, self.args.device_train)
+        next_state_batch = to_tensor(next_state_batch, self.args.device_train)
+        done_batch = to_tensor(done_batch, self.args.device_train)
 
         if cql:
-            self.q_train_cql(state_batch, action_batch, reward_batch, next_state_batch, done_batch)
+            self.q_train_cql(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras)
         else:
-            self.q_train(state_batch, action_batch, reward_batch, next_state_batch, done_batch)
+            self.q_train(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras)
         with torch.no_grad():
-            soft_update(self.target_q1, self.q1, self.tau)
-            soft_update(self.target_q2, self.q2, self.tau)
+            soft_update(self.target_q, self.q, self.tau)
 
     def test_q(self,batch):
-        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch
-        state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-        action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
-        with torch.no_grad():
-            q_val1, q_val2 = self.q1(state_batch, action_batch), self.q2(state_batch, action_batch)
-        return q_val1, q_val2
-
-    def q_train(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch):
-        self.q1_opt.zero_grad()
-        self.q2_opt.zero_grad()
-        q_val1,q_val2 = self.q1(state_batch,action_batch), self.q2(state_batch,action_batch)
-        # reward_batch, done_batch = reward_batch.reshape(q_val1.shape[0]), done_batch.reshape(q_val1.shape[0])
+        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch[:5]
+        state_batch = to_tensor(state_batch, self.args.device_train)
+        action_batch = to_tensor(action_batch, self.args.device_train)
         with torch.no_grad():
-            noise = (torch.randn_like(action_batch) * 0.2).clamp(-0.5, 0.5)
-            next_action_batch = (self.target_pi(next_state_batch) + noise).clamp(-1.,1.)
-            next_q_val1, next_q_val2 = self.target_q1(next_state_batch,next_action_batch), self.target_q2(next_state_batch,next_action_batch)
-            minq = torch.min(next_q_val1,next_q_val2)
-            target_ = reward_batch + self.gamma*(1-done_batch)*minq
-
-        q1_loss = F.mse_loss(target_,q_val1)
-        q2_loss = F.mse_loss(target_,q_val2)
-
-        q_loss = q1_loss + q2_loss
-        q_loss.backward()
-        self.q1_opt.step()
-        self.q2_opt.step()
+            q_vals = self.q(state_batch, action_batch)
+        return q_vals[0], q_vals[1]
 
-    def q_train_cql(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch):
-        self.q1_opt.zero_grad()
-        self.q2_opt.zero_grad()
-        q_val1,q_val2 = self.q1(state_batch,action_batch), self.q2(state_batch,action_batch)
+    def q_train(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None):
+        self.q_opt.zero_grad()
+        q_vals = self.q(state_batch,action_batch)
+        # reward_batch, done_batch = reward_batch.reshape(q_vals.shape[1]), done_batch.reshape(q_vals.shape[1])
         with torch.no_grad():
             noise = (torch.randn_like(action_batch) * 0.2).clamp(-0.5, 0.5)
             next_action_batch = (self.target_pi(next_state_batch) + noise).clamp(-1.,1.)
-            next_q_val1, next_q_val2 = self.target_q1(next_state_batch,next_action_batch), self.target_q2(next_state_batch,next_action_batch)
-            minq = torch.min(next_q_val1,next_q_val2)
-            target_ = reward_batch + self.gamma*(1-done_batch)*minq
+            minq = self.target_q(next_state_batch,next_action_batch).min(0)[0]
+            target_ = reward_batch + td_discount(extras, self.gamma, done_batch, self.args.device_train)*minq
 
-        q1_loss = F.mse_loss(target_,q_val1)
-        q2_loss = F.mse_loss(target_,q_val2)
+        weights = batch_weights(extras, self.args.device_train)
+        q_loss = td_loss(target_,q_vals,weights)
+        update_priorities(extras, target_, q_vals)
 
+        q_loss.backward()
+        self.q_opt.step()
+        return q_loss.detach()
 
-        #====여까지는 그냥 SAC랑 같음
+    def q_train_cql(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None):
+        self.q_opt.zero_grad()
         batch_size = action_batch.shape[0]
         action_dim = action_batch.shape[-1]
         cql_random_actions = action_batch.new_empty((batch_size, self.cql_n_actions, action_dim),requires_grad=False).uniform_(-1, 1)
@@ -543,69 +911,214 @@ class TD3_Agent:
         cql_next_actions    = self.pi(next_state_batch, repeat=self.cql_n_actions)
         cql_current_actions, cql_next_actions = cql_current_actions.detach(), cql_next_actions.detach()
 
+        q_vals, cql_q_rand, cql_q_current_actions, cql_q_next_actions = cql_q_values(
+            self.q, state_batch, action_batch, cql_random_actions, cql_current_actions, cql_next_actions)
+        with torch.no_grad():
+            noise = (torch.randn_like(action_batch) * 0.2).clamp(-0.5, 0.5)
+            next_action_batch = (self.target_pi(next_state_batch) + noise).clamp(-1.,1.)
+            minq = self.target_q(next_state_batch,next_action_batch).min(0)[0]
+            target_ = reward_batch + td_discount(extras, self.gamma, done_batch, self.args.device_train)*minq
 
+        weights = batch_weights(extras, self.args.device_train)
+        q_loss = td_loss(target_,q_vals,weights)
+        update_priorities(extras, target_, q_vals)
 
-        cql_q1_rand = self.q1(state_batch, cql_random_actions)
-        cql_q2_rand = self.q2(state_batch, cql_random_actions)
-        cql_q1_current_actions = self.q1(state_batch, cql_current_actions)
-        cql_q2_current_actions = self.q2(state_batch, cql_current_actions)
-        cql_q1_next_actions = self.q1(state_batch, cql_next_actions)
-        cql_q2_next_actions = self.q2(state_batch , cql_next_actions)
 
-        cql_cat_q1 = torch.cat(
-            [cql_q1_rand, torch.unsqueeze(q_val1, 1), cql_q1_next_actions, cql_q1_current_actions], dim=1
-        )
-        cql_cat_q2 = torch.cat(
-            [cql_q2_rand, torch.unsqueeze(q_val2, 1), cql_q2_next_actions, cql_q2_current_actions], dim=1
+        #====여까지는 그냥 SAC랑 같음
+        cql_cat_q = torch.cat(
+            [cql_q_rand, torch.unsqueeze(q_vals, -1), cql_q_next_actions, cql_q_current_actions], dim=-1
         )
 
-        cql_qf1_ood = torch.logsumexp(cql_cat_q1 / self.cql_temp, dim=1) * self.cql_temp
-        cql_qf2_ood = torch.logsumexp(cql_cat_q2 / self.cql_temp, dim=1) * self.cql_temp
+        cql_qf_ood = torch.logsumexp(cql_cat_q / self.cql_temp, dim=-1) * self.cql_temp
 
         """Subtract the log likelihood of data"""
-        cql_qf1_diff = torch.clamp(
-            cql_qf1_ood - q_val1,
+        # member별 (E,)
+        cql_qf_diff = torch.clamp(
+            cql_qf_ood - q_vals,
             self.cql_clip_diff_min,
             self.cql_clip_diff_max,
-        ).mean()
-        cql_qf2_diff = torch.clamp(
-            cql_qf2_ood - q_val2,
-            self.cql_clip_diff_min,
-            self.cql_clip_diff_max,
-        ).mean()
+        ).mean(-1)
 
 
         if self.cql_lagrange:
             alpha_prime = torch.clamp(torch.exp(self.log_alpha_prime), min=0.0, max=1000000.0)
-            cql_min_qf1_loss = alpha_prime * self.cql_min_q_weight * (
-                        cql_qf1_diff - self.cql_target_action_gap)
-            cql_min_qf2_loss = alpha_prime * self.cql_min_q_weight * (
-                        cql_qf2_diff - self.cql_target_action_gap)
-
-            self.alpha_prime_opt.zero_grad()
-            alpha_prime_loss = (-cql_min_qf1_loss - cql_min_qf2_loss) * 0.5
-            alpha_prime_loss.backward(retain_graph=True)
-            self.alpha_prime_opt.step()
+            # critic은 alpha_prime을, alpha_prime은 cql diff를 상수로 -> 두 loss를 더해서 backward 한번
+            cql_min_qf_loss = alpha_prime.detach() * self.cql_min_q_weight * (
+                        cql_qf_diff - self.cql_target_action_gap)
+            alpha_prime_loss = -(alpha_prime * self.cql_min_q_weight * (
+                        cql_qf_diff.detach() - self.cql_target_action_gap)).mean()
         else:
-            cql_min_qf1_loss = cql_qf1_diff * self.cql_min_q_weight
-            cql_min_qf2_loss = cql_qf2_diff * self.cql_min_q_weight
+            cql_min_qf_loss = cql_qf_diff * self.cql_min_q_weight
+            alpha_prime_loss = 0.0
 
-        q1_loss_add_cql =  q1_loss + cql_min_qf1_loss
-        q2_loss_add_cql =  q2_loss + cql_min_qf2_loss
+        q_loss_add_cql =  q_loss + cql_min_qf_loss.sum() + alpha_prime_loss
 
 
-        q1_loss_add_cql.backward(retain_graph=True)
-        self.q1_opt.step()
-        q2_loss_add_cql.backward()
-        self.q2_opt.step()
+        q_loss_add_cql.backward()
+        self.q_opt.step()
+        return q_loss_add_cql.detach()
 
 
     def pi_train(self,state_batch):
         self.pi_opt.zero_grad()
         action = self.pi(state_batch)
-        pi_loss = -self.q1(state_batch,action).mean()
+        pi_loss = -self.q(state_batch,action)[0].mean()
         pi_loss.backward()
         self.pi_opt.step()
+        return pi_loss.detach()
+
+
+class MultiSeed_TD3_Agent:
+    # seed N개의 TD3_Agent (offline train_off)를 process 하나에서: network parameter를 (N, ...)로 쌓아두고
+    # torch.func.vmap + functional_call로 N개 update를 batched 연산 한번에. Adam은 elementwise라서 쌓은 parameter에
+    # optimizer 하나 = seed별 Adam N개. seed마다 초기화, dataset batch (d4rl_dataset.get_seed_data), noise generator가 따로
+    # batch: (o, a, r, no, done[, dict(discount)]) 각각 (N, B, ...). prioritized sampling, CQL Lagrange는 지원 안함
+    def __init__(self,o_dim,a_dim,args,seeds):
+        self.o_dim, self.a_dim = o_dim, a_dim
+        self.args = args
+        self.seeds = list(seeds)
+        self.num_seeds = len(self.seeds)
+        self.gamma = args.SAC_gamma
+        self.hidden_size = args.SAC_hidden_size
+        self.batch_size = args.SAC_batch_size
+        self.tau = args.SAC_tau
+        self.lr = args.SAC_lr
+        self.update_pi = args.update_pi_ratio
+        self.update_count = 0
+
+        #Define networks
+        qs, pis = [], []
+        for seed in self.seeds:
+            # 같은 seed로 만든 TD3_Agent와 같은 초기값 (q 다음 pi 순서)
+            torch.manual_seed(seed)
+            qs.append(EnsembleQnet(self.o_dim, self.a_dim, self.hidden_size, args.critic_ensemble_size).to(args.device_train))
+            pis.append(Det_Policy(self.o_dim, self.a_dim, self.hidden_size).to(args.device_train))
+        # functional_call용 틀 (parameter 없음)
+        self.q_base = deepcopy(qs[0]).to('meta')
+        self.pi_base = deepcopy(pis[0]).to('meta')
+        self.q = stack_module_state(qs)[0]
+        self.pi = stack_module_state(pis)[0]
+        self.target_q = {key: value.detach().clone() for key, value in self.q.items()}
+        self.target_pi = {key: value.detach().clone() for key, value in self.pi.items()}
+
+        # seed별 random stream: dataset batch는 numpy, target noise / CQL random action은 torch
+        self.rngs = [np.random.default_rng(seed) for seed in self.seeds]
+        self.generators = [torch.Generator(device=args.device_train).manual_seed(seed) for seed in self.seeds]
+
+        #Define optimizer
+        self.q_opt = torch.optim.Adam(self.q.values(), lr=self.lr)
+        self.pi_opt = torch.optim.Adam(self.pi.values(), lr=self.lr)
+        #====cql hyper==== (TD3_Agent와 같음)
+        self.cql_n_actions = 10
+        self.cql_temp = 1.0
+        self.cql_min_q_weight = 5.0
+        self.cql_clip_diff_min = -np.inf
+        self.cql_clip_diff_max =  np.inf
+        set_autocast(args.autocast, self.q_base, self.pi_base)
+
+    def sample(self, dataset):
+        return dataset.get_seed_data(self.batch_size, self.rngs)
+
+    def seed_random(self, shape, uniform=False):
+        # seed마다 자기 generator로 뽑아서 (N, *shape)
+        sample = torch.rand if uniform else torch.randn
+        return torch.stack([sample(shape, generator=generator, device=self.args.device_train) for generator in self.generators])
+
+    def select_action(self,o,eval=True):
+        # o: seed별 env의 obs (N, o_dim) -> action (N, a_dim)
+        o = to_tensor(np.asarray(o).reshape([self.num_seeds, 1, -1]), self.args.device_train)
+        with torch.no_grad():
+            action = vmap(self.pi_forward)(self.pi, o)[:, 0]
+        action = action.cpu().numpy()
+        if not eval:
+            action = (action + 0.1 * np.stack([rng.normal(0.0, 1.0, self.a_dim) for rng in self.rngs])).clip(-1.0,1.0)
+        return action
+
+    def pi_forward(self, pi_params, state_batch, repeat=None):
+        return functional_call(self.pi_base, pi_params, (state_batch,), dict(repeat=repeat))
+
+    def q_forward(self, q_params, state_batch, action_batch):
+        return functional_call(self.q_base, q_params, (state_batch, action_batch))
+
+    def train_off(self, batch, cql=False):
+        (state_batch, action_batch, reward_batch, next_state_batch, done_batch), extras = unpack_batch(batch)
+
+        state_batch = to_tensor(state_batch, self.args.device_train)
+        action_batch = to_tensor(action_batch, self.args.device_train)
+        reward_batch = to_tensor(reward_batch, self.args.device_train)
+        next_state_batch = to_tensor(next_state_batch, self.args.device_train)
+        done_batch = to_tensor(done_batch, self.args.device_train)
+        return self.update(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras, cql)
+
+    def update(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None,cql=False):
+        # 반환 loss는 seed별 (N,)
+        losses = {}
+        discount = td_discount(extras, self.gamma, done_batch, self.args.device_train)
+        noise = (self.seed_random(action_batch.shape[1:]) * 0.2).clamp(-0.5, 0.5)
+        self.q_opt.zero_grad()
+        if cql:
+            random_actions = self.seed_random((action_batch.shape[1], self.cql_n_actions, self.a_dim), uniform=True) * 2 - 1
+            q_loss = vmap(self.q_loss_cql)(self.q, self.target_q, self.pi, self.target_pi, state_batch, action_batch,
+                                           reward_batch, next_state_batch, discount, noise, random_actions)
+        else:
+            q_loss = vmap(self.q_loss)(self.q, self.target_q, self.target_pi, state_batch, action_batch,
+                                       reward_batch, next_state_batch, discount, noise)
+        # seed끼리 parameter를 공유하지 않으므로 합의 gradient = seed별 gradient
+        q_loss.sum().backward()
+        self.q_opt.step()
+        losses['q_loss'] = q_loss.detach()
+
+        if (self.update_count % self.update_pi) == 0:
+            self.pi_opt.zero_grad()
+            q_params = {key: value.detach() for key, value in self.q.items()}
+            pi_loss = vmap(self.pi_loss)(self.pi, q_params, state_batch)
+            pi_loss.sum().backward()
+            self.pi_opt.step()
+            losses['pi_loss'] = pi_loss.detach()
+
+        if (self.update_count % 2.0) == 0:
+            with torch.no_grad():
+                torch._foreach_lerp_(list(self.target_q.values()), list(self.q.values()), self.tau)
+                torch._foreach_lerp_(list(self.target_pi.values()), list(self.pi.values()), self.tau)
+
+        self.update_count += 1
+        return losses
+
+    def td_target(self, target_q, target_pi, reward_batch, next_state_batch, discount, noise):
+        # target network parameter는 grad가 없는 tensor
+        next_action_batch = (self.pi_forward(target_pi, next_state_batch) + noise).clamp(-1.,1.)
+        minq = self.q_forward(target_q, next_state_batch, next_action_batch).min(0)[0]
+        return reward_batch + discount*minq
+
+    def q_loss(self, q, target_q, target_pi, state_batch, action_batch, reward_batch, next_state_batch, discount, noise):
+        # seed 하나 (vmap 안): TD3_Agent.q_train의 loss
+        q_vals = self.q_forward(q, state_batch, action_batch)
+        target_ = self.td_target(target_q, target_pi, reward_batch, next_state_batch, discount, noise)
+        return td_loss(target_, q_vals)
+
+    def q_loss_cql(self, q, target_q, pi, target_pi, state_batch, action_batch, reward_batch, next_state_batch, discount, noise, random_actions):
+        # seed 하나 (vmap 안): TD3_Agent.q_train_cql의 loss (cql_lagrange=False)
+        current_actions = self.pi_forward(pi, state_batch, self.cql_n_actions).detach()
+        next_actions = self.pi_forward(pi, next_state_batch, self.cql_n_actions).detach()
+        q_vals, cql_q_rand, cql_q_current_actions, cql_q_next_actions = cql_q_values(
+            lambda o, a: self.q_forward(q, o, a), state_batch, action_batch, random_actions, current_actions, next_actions)
+        target_ = self.td_target(target_q, target_pi, reward_batch, next_state_batch, discount, noise)
+        q_loss = td_loss(target_, q_vals)
+
+        cql_cat_q = torch.cat(
+            [cql_q_rand, torch.unsqueeze(q_vals, -1), cql_q_next_actions, cql_q_current_actions], dim=-1
+        )
+        cql_qf_ood = torch.logsumexp(cql_cat_q / self.cql_temp, dim=-1) * self.cql_temp
+        cql_qf_diff = torch.clamp(
+            cql_qf_ood - q_vals,
+            self.cql_clip_diff_min,
+            self.cql_clip_diff_max,
+        ).mean(-1)
+        return q_loss + (cql_qf_diff * self.cql_min_q_weight).sum()
+
+    def pi_loss(self, pi, q, state_batch):
+        action = self.pi_forward(pi, state_batch)
+        return -self.q_forward(q, state_batch, action)[0].mean()
 
 
 
@@ -615,14 +1128,13 @@ class BC_agent:
         self.o_dim, self.a_dim = o_dim, a_dim
         self.args = args
         self.lr = args.BC_lr
-        self.bc = Det_Policy(o_dim,a_dim,args.BC_hidden_size).to(args.device_train)
-        self.target_bc = deepcopy(self.bc)
+        self.bc = flatten_parameters(Det_Policy(o_dim,a_dim,args.BC_hidden_size).to(args.device_train))
+        self.target_bc = target_copy(self.bc)
         self.bc_opt = torch.optim.Adam(self.bc.parameters(), lr=self.lr)
 
         self.hidden_size = args.SAC_hidden_size
         #Define networks
-        self.q1 = Qnet(self.o_dim, self.a_dim, self.hidden_size).to(args.device_train)
-        self.q2 = Qnet(self.o_dim, self.a_dim, self.hidden_size).to(args.device_train)
+        self.q = flatten_parameters(EnsembleQnet(self.o_dim, self.a_dim, self.hidden_size, args.critic_ensemble_size).to(args.device_train))
         self.n_actions = 50
         self.update_count = 0
         self.update_pi = args.update_pi_ratio
@@ -630,9 +1142,12 @@ class BC_agent:
         #==================================================================
         self.gamma = args.SAC_gamma
         self.tau   = args.SAC_tau
+        #Define CQL value
+        self.log_alpha_prime = torch.tensor(1.0, requires_grad=True, device=args.device_train)
+
         #Define optimizer
-        self.q1_opt = torch.optim.Adam(self.q1.parameters(), lr=self.lr)
-        self.q2_opt = torch.optim.Adam(self.q2.parameters(), lr=self.lr)
+        # CQL Lagrange multiplier도 critic과 같은 optimizer로 (backward 한번, step 한번)
+        self.q_opt = torch.optim.Adam([{'params': self.q.parameters()}, {'params': [self.log_alpha_prime]}], lr=self.lr)
         #====cql hyper====
         # CQL Hyperparmeters===나중에 args로 바꿔줘야함
         self.backup_entropy = False # 보류
@@ -645,37 +1160,52 @@ class BC_agent:
         self.cql_max_target_backup = False
         self.cql_clip_diff_min = -np.inf
         self.cql_clip_diff_max =  np.inf
+        set_autocast(args.autocast, self.q, self.bc, self.target_bc)
+        compile_update(self, ('weightedBC_train', 'q_train', 'q_train_cql'), args.compile)
+        self.inference_bc = InferencePolicy(self.bc, args.device_eval)
 
     def init_bc(self,dir):
         self.bc.load_state_dict(torch.load(dir)['policy'])
-        self.target_bc = deepcopy(self.bc)
+        self.target_bc = target_copy(self.bc)
     def init_q(self,dir):
-        self.q1.load_state_dict(torch.load(dir)['q1'])
-        self.q2.load_state_dict(torch.load(dir)['q2'])
-        self.target_q1 = deepcopy(self.q1)
-        self.target_q2 = deepcopy(self.q2)
+        # checkpoint는 Qnet 두개 ('q1', 'q2') 형식 그대로라 critic_ensemble_size 2일 때만
+        assert self.q.ensemble_size == 2, "init_q checkpoint has 2 critics (q1, q2), got critic_ensemble_size %d" % self.q.ensemble_size
+        checkpoint = torch.load(dir)
+        self.q.load_qnet_state_dicts([checkpoint['q1'], checkpoint['q2']])
+        self.target_q = target_copy(self.q)
 
     def select_action(self, o, eval=False):
-        action  = self.bc(torch.FloatTensor(o).to(self.args.device_train))
-        return action.cpu().detach().numpy()[0]
+        return self.inference_bc(o)
 
     def train_bc(self, batch):
-        self.bc.train()
-        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch
-        state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-        action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
+        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch[:5]
+        state_batch = to_tensor(state_batch, self.args.device_train)
+        action_batch = to_tensor(action_batch, self.args.device_train)
+        return self.bc_train(state_batch, action_batch)
 
+    def bc_train(self, state_batch, action_batch):
+        self.bc.train()
         self.bc_opt.zero_grad()
         pred_action = self.bc(state_batch)
         action_loss = F.mse_loss(pred_action,action_batch)
         action_loss.backward()
         self.bc_opt.step()
+        return action_loss.detach()
 
     def train_weightedQ(self,batch):
-        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch
-        state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-        action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
-        self.weightedBC_train(state_batch, action_batch, reward_batch, next_state_batch, done_batch)
+        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch[:5]
+        state_batch = to_tensor(state_batch, self.args.device_train)
+        action_batch = to_tensor(action_batch, self.args.device_train)
+        return self.weightedBC_train(state_batch, action_batch, reward_batch, next_state_batch, done_batch)
+
+    def train_many(self, batches, num_steps=None, update='weightedQ'):
+        # (K, B, ...) batch (stack_batches) 또는 sampler로 K번 update, loss 평균 반환
+        # update: 'bc' (train_bc), 'weightedQ' (train_weightedQ), 'cql' (temp_cql)
+        update_fns = dict(
+            bc=lambda o, a, r, no, done, extras: dict(bc_loss=self.bc_train(o, a)),
+            weightedQ=lambda o, a, r, no, done, extras: dict(bc_loss=self.weightedBC_train(o, a, r, no, done)),
+            cql=self.cql_update)
+        return run_updates(update_fns[update], batches, self.args.device_train, num_steps)
 
 
     # def train_weightedQimprove(self,batch,cql=False):
@@ -704,21 +1234,24 @@ class BC_agent:
     #
     #     self.update_count += 1
     def temp_cql(self,batch):
-        state_batch, action_batch, reward_batch, next_state_batch, done_batch = batch
+        (state_batch, action_batch, reward_batch, next_state_batch, done_batch), extras = unpack_batch(batch)
 
-        state_batch = torch.FloatTensor(state_batch).to(self.args.device_train)
-        action_batch = torch.FloatTensor(action_batch).to(self.args.device_train)
-        reward_batch = torch.FloatTensor(reward_batch).to(self.args.device_train)
-        next_state_batch = torch.FloatTensor(next_state_batch).to(self.args.device_train)
-        done_batch = torch.FloatTensor(done_batch).to(self.args.device_train)
-        self.q_train_cql(state_batch, action_batch, reward_batch, next_state_batch, done_batch)
+        state_batch = to_tensor(state_batch, self.args.device_train)
+        action_batch = to_tensor(action_batch, self.args.device_train)
+        reward_batch = to_tensor(reward_batch, self.args.device_train)
+        next_state_batch = to_tensor(next_state_batch, self.args.device_train)
+        done_batch = to_tensor(done_batch, self.args.device_train)
+        return self.cql_update(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras)
+
+    def cql_update(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None):
+        q_loss = self.q_train_cql(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras)
 
         if (self.update_count % 2.0) == 0:
             with torch.no_grad():
-                soft_update(self.target_q1, self.q1, self.tau)
-                soft_update(self.target_q2, self.q2, self.tau)
+                soft_update(self.target_q, self.q, self.tau)
                 hard_update(self.target_bc, self.bc)
         self.update_count += 1
+        return dict(q_loss=q_loss)
 
 
     def weightedBC_train(self,state_batch, action_batch, reward_batch, next_state_batch, done_batch):
@@ -726,56 +1259,41 @@ class BC_agent:
         # 방법1 uniform norm. 방법2 batch norm
         random_actions = action_batch.new_empty((state_batch.shape[0], self.n_actions, self.a_dim),requires_grad=False).uniform_(-1, 1)
         with torch.no_grad():
-            q_random_val1,q_random_val2 = self.q1(state_batch,random_actions), self.q2(state_batch,random_actions) #state는 그대로 [256,17] action은 [256,10,6이 들어가면된다.]
-            min_q = torch.min(q_random_val1, q_random_val2).mean(dim=1)
+            q_random_vals = self.q(state_batch,random_actions) #state는 그대로 [256,17] action은 [256,10,6이 들어가면된다.] -> [E,256,10]
+            min_q = q_random_vals.min(0)[0].mean(dim=1)
 
-            q_val1, q_val2 = self.q1(state_batch, action_batch), self.q2(state_batch, action_batch)
+            q_vals = self.q(state_batch, action_batch)
 
-            weight = torch.min((q_val1-min_q)/abs(min_q),(q_val2-min_q)/abs(min_q)).clamp(0.0,4.0)
+            weight = ((q_vals-min_q)/abs(min_q)).min(0)[0].clamp(0.0,4.0)
 
         self.bc_opt.zero_grad()
         pred_action = self.bc(state_batch)
         action_loss = torch.mean(((pred_action - action_batch)**2)*weight.reshape(-1, 1))
         action_loss.backward()
         self.bc_opt.step()
+        return action_loss.detach()
 
 
-    def q_train(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch):
-        self.q1_opt.zero_grad()
-        self.q2_opt.zero_grad()
-        q_val1,q_val2 = self.q1(state_batch,action_batch), self.q2(state_batch,action_batch)
-        # reward_batch, done_batch = reward_batch.reshape(q_val1.shape[0]), done_batch.reshape(q_val1.shape[0])
+    def q_train(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None):
+        self.q_opt.zero_grad()
+        q_vals = self.q(state_batch,action_batch)
+        # reward_batch, done_batch = reward_batch.reshape(q_vals.shape[1]), done_batch.reshape(q_vals.shape[1])
         with torch.no_grad():
             noise = (torch.randn_like(action_batch) * 0.2).clamp(-0.5, 0.5)
             next_action_batch = (self.target_bc(next_state_batch) + noise).clamp(-1.,1.)
-            next_q_val1, next_q_val2 = self.target_q1(next_state_batch,next_action_batch), self.target_q2(next_state_batch,next_action_batch)
-            minq = torch.min(next_q_val1,next_q_val2)
-            target_ = reward_batch + self.gamma*(1-done_batch)*minq
+            minq = self.target_q(next_state_batch,next_action_batch).min(0)[0]
+            target_ = reward_batch + td_discount(extras, self.gamma, done_batch, self.args.device_train)*minq
 
-        q1_loss = F.mse_loss(target_,q_val1)
-        q2_loss = F.mse_loss(target_,q_val2)
+        weights = batch_weights(extras, self.args.device_train)
+        q_loss = td_loss(target_,q_vals,weights)
+        update_priorities(extras, target_, q_vals)
 
-        q_loss = q1_loss + q2_loss
         q_loss.backward()
-        self.q1_opt.step()
-        self.q2_opt.step()
-
-    def q_train_cql(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch):
-        self.q1_opt.zero_grad()
-        self.q2_opt.zero_grad()
-        q_val1,q_val2 = self.q1(state_batch,action_batch), self.q2(state_batch,action_batch)
-        with torch.no_grad():
-            noise = (torch.randn_like(action_batch) * 0.2).clamp(-0.5, 0.5)
-            next_action_batch = (self.target_bc(next_state_batch) + noise).clamp(-1.,1.)
-            next_q_val1, next_q_val2 = self.target_q1(next_state_batch,next_action_batch), self.target_q2(next_state_batch,next_action_batch)
-            minq = torch.min(next_q_val1,next_q_val2)
-            target_ = reward_batch + self.gamma*(1-done_batch)*minq
-
-        q1_loss = F.mse_loss(target_,q_val1)
-        q2_loss = F.mse_loss(target_,q_val2)
+        self.q_opt.step()
+        return q_loss.detach()
 
-
-        #====여까지는 그냥 SAC랑 같음
+    def q_train_cql(self,state_batch,action_batch,reward_batch,next_state_batch,done_batch,extras=None):
+        self.q_opt.zero_grad()
         batch_size = action_batch.shape[0]
         action_dim = action_batch.shape[-1]
         cql_random_actions = action_batch.new_empty((batch_size, self.cql_n_actions, action_dim),requires_grad=False).uniform_(-1, 1)
@@ -785,61 +1303,52 @@ class BC_agent:
         cql_next_actions    = self.bc(next_state_batch, repeat=self.cql_n_actions)
         cql_current_actions, cql_next_actions = cql_current_actions.detach(), cql_next_actions.detach()
 
+        q_vals, cql_q_rand, cql_q_current_actions, cql_q_next_actions = cql_q_values(
+            self.q, state_batch, action_batch, cql_random_actions, cql_current_actions, cql_next_actions)
+        with torch.no_grad():
+            noise = (torch.randn_like(action_batch) * 0.2).clamp(-0.5, 0.5)
+            next_action_batch = (self.target_bc(next_state_batch) + noise).clamp(-1.,1.)
+            minq = self.target_q(next_state_batch,next_action_batch).min(0)[0]
+            target_ = reward_batch + td_discount(extras, self.gamma, done_batch, self.args.device_train)*minq
 
+        weights = batch_weights(extras, self.args.device_train)
+        q_loss = td_loss(target_,q_vals,weights)
+        update_priorities(extras, target_, q_vals)
 
-        cql_q1_rand = self.q1(state_batch, cql_random_actions)
-        cql_q2_rand = self.q2(state_batch, cql_random_actions)
-        cql_q1_current_actions = self.q1(state_batch, cql_current_actions)
-        cql_q2_current_actions = self.q2(state_batch, cql_current_actions)
-        cql_q1_next_actions = self.q1(state_batch, cql_next_actions)
-        cql_q2_next_actions = self.q2(state_batch , cql_next_actions)
 
-        cql_cat_q1 = torch.cat(
-            [cql_q1_rand, torch.unsqueeze(q_val1, 1), cql_q1_next_actions, cql_q1_current_actions], dim=1
-        )
-        cql_cat_q2 = torch.cat(
-            [cql_q2_rand, torch.unsqueeze(q_val2, 1), cql_q2_next_actions, cql_q2_current_actions], dim=1
+        #====여까지는 그냥 SAC랑 같음
+        cql_cat_q = torch.cat(
+            [cql_q_rand, torch.unsqueeze(q_vals, -1), cql_q_next_actions, cql_q_current_actions], dim=-1
         )
 
-        cql_qf1_ood = torch.logsumexp(cql_cat_q1 / self.cql_temp, dim=1) * self.cql_temp
-        cql_qf2_ood = torch.logsumexp(cql_cat_q2 / self.cql_temp, dim=1) * self.cql_temp
+        cql_qf_ood = torch.logsumexp(cql_cat_q / self.cql_temp, dim=-1) * self.cql_temp
 
         """Subtract the log likelihood of data"""
-        cql_qf1_diff = torch.clamp(
-            cql_qf1_ood - q_val1,
-            self.cql_clip_diff_min,
-            self.cql_clip_diff_max,
-        ).mean()
-        cql_qf2_diff = torch.clamp(
-            cql_qf2_ood - q_val2,
+        # member별 (E,)
+        cql_qf_diff = torch.clamp(
+            cql_qf_ood - q_vals,
             self.cql_clip_diff_min,
             self.cql_clip_diff_max,
-        ).mean()
+        ).mean(-1)
 
 
         if self.cql_lagrange:
             alpha_prime = torch.clamp(torch.exp(self.log_alpha_prime), min=0.0, max=1000000.0)
-            cql_min_qf1_loss = alpha_prime * self.cql_min_q_weight * (
-                        cql_qf1_diff - self.cql_target_action_gap)
-            cql_min_qf2_loss = alpha_prime * self.cql_min_q_weight * (
-                        cql_qf2_diff - self.cql_target_action_gap)
-
-            self.alpha_prime_opt.zero_grad()
-            alpha_prime_loss = (-cql_min_qf1_loss - cql_min_qf2_loss) * 0.5
-            alpha_prime_loss.backward(retain_graph=True)
-            self.alpha_prime_opt.step()
+            # critic은 alpha_prime을, alpha_prime은 cql diff를 상수로 -> 두 loss를 더해서 backward 한번
+            cql_min_qf_loss = alpha_prime.detach() * self.cql_min_q_weight * (
+                        cql_qf_diff - self.cql_target_action_gap)
+            alpha_prime_loss = -(alpha_prime * self.cql_min_q_weight * (
+                        cql_qf_diff.detach() - self.cql_target_action_gap)).mean()
         else:
-            cql_min_qf1_loss = cql_qf1_diff * self.cql_min_q_weight
-            cql_min_qf2_loss = cql_qf2_diff * self.cql_min_q_weight
+            cql_min_qf_loss = cql_qf_diff * self.cql_min_q_weight
+            alpha_prime_loss = 0.0
 
-        q1_loss_add_cql =  q1_loss + cql_min_qf1_loss
-        q2_loss_add_cql =  q2_loss + cql_min_qf2_loss
+        q_loss_add_cql =  q_loss + cql_min_qf_loss.sum() + alpha_prime_loss
 
 
-        q1_loss_add_cql.backward(retain_graph=True)
-        self.q1_opt.step()
-        q2_loss_add_cql.backward()
-        self.q2_opt.step()
+        q_loss_add_cql.backward()
+        self.q_opt.step()
+        return q_loss_add_cql.detach()
 
 
 
@@ -1,14 +1,59 @@
+import math
 import torch
 import torch.nn as nn
-from torch.distributions.normal import Normal
+import torch.nn.functional as F
+from copy import deepcopy
+from contextlib import nullcontext
+
+def flatten_parameters(module):
+    # parameter들을 연속된 flat buffer 하나의 view로 바꿈 -> soft/hard update, snapshot이 flat buffer 연산 한번.
+    # .to(device), deepcopy 하면 view가 끊기니까 그 뒤에 호출해야 함 (optimizer 만들기 전에)
+    params = list(module.parameters())
+    flat = torch.cat([p.data.reshape(-1) for p in params])
+    offset = 0
+    for p in params:
+        p.data = flat[offset:offset + p.numel()].view_as(p)
+        offset += p.numel()
+    module.flat_params = flat
+    return module
+
+def flat_params(module):
+    # flatten_parameters 이후에 .to() 등으로 view가 끊겼으면 None
+    flat = getattr(module, 'flat_params', None)
+    if flat is None or next(module.parameters()).data_ptr() != flat.data_ptr():
+        return None
+    return flat
+
+def target_copy(module):
+    # deepcopy는 view 관계를 복사하지 않으므로 target은 따로 flatten
+    return flatten_parameters(deepcopy(module))
+
+AUTOCAST_DTYPES = dict(bfloat16=torch.bfloat16)
+
+def autocast(x, dtype):
+    # network의 autocast_dtype이 None이면 float32 그대로. weight (master)는 항상 float32
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(x.device.type, dtype=dtype)
+
+def set_autocast(dtype, *modules):
+    # dtype: None 또는 'bfloat16' (args.autocast)
+    for module in modules:
+        module.autocast_dtype = AUTOCAST_DTYPES[dtype] if dtype is not None else None
 
 def soft_update(target, source, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+    target_flat, source_flat = flat_params(target), flat_params(source)
+    if target_flat is not None and source_flat is not None:
+        target_flat.lerp_(source_flat, tau)
+    else:
+        torch._foreach_lerp_([p.data for p in target.parameters()], [p.data for p in source.parameters()], tau)
 
 def hard_update(target, source):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(param.data)
+    target_flat, source_flat = flat_params(target), flat_params(source)
+    if target_flat is not None and source_flat is not None:
+        target_flat.copy_(source_flat)
+    else:
+        torch._foreach_copy_([p.data for p in target.parameters()], [p.data for p in source.parameters()])
 
 def weight_init_Xavier(module):
     if isinstance(module, nn.Linear):
@@ -68,6 +113,15 @@ def multiple_action_q_function(forward):
 
 
 
+def first_layer_multi_action(o_input, a_input, weight, bias):
+    # [obs, action] @ weight + bias를 obs (B, o_dim) 한번, action (B, N, a_dim)은 따로 계산해서 broadcasting으로 합침.
+    # weight: (o_dim + a_dim, h) 또는 ensemble이면 (E, o_dim + a_dim, h), bias는 (h,) / (E, 1, h) -> (B, N, h) / (E, B, N, h)
+    o_dim = o_input.shape[-1]
+    o_proj = torch.matmul(o_input, weight[..., :o_dim, :]) + bias
+    a_proj = torch.matmul(a_input.reshape(-1, a_input.shape[-1]), weight[..., o_dim:, :])
+    return torch.unsqueeze(o_proj, -2) + a_proj.reshape(a_proj.shape[:-2] + a_input.shape[:2] + a_proj.shape[-1:])
+
+
 class Qnet(nn.Module):
     def __init__(self, o_dim, a_dim, h_size=256):
         super(Qnet,self).__init__()
@@ -77,14 +131,69 @@ class Qnet(nn.Module):
         self.relu1 = nn.ReLU()
         self.relu2 = nn.ReLU()
 
-    @multiple_action_q_function
     def forward(self,o_input:torch.Tensor,a_input:torch.Tensor):
-        inputs = torch.concat([o_input,a_input],dim=-1)
-        layer = self.relu1(self.fc1(inputs))
+        if a_input.ndim == 3 and o_input.ndim == 2:
+            # action이 (B, N, a_dim)이면 fc1을 obs / action 부분으로 나눠서 obs projection은 state당 한번만,
+            # action projection과 broadcasting으로 더함 (= fc1([obs, action])) -> 출력 (B, N)
+            layer = self.relu1(first_layer_multi_action(o_input, a_input, self.fc1.weight.t(), self.fc1.bias))
+        else:
+            inputs = torch.concat([o_input,a_input],dim=-1)
+            layer = self.relu1(self.fc1(inputs))
         layer = self.relu2(self.fc2(layer))
         qval  = self.fc3(layer)
         return torch.squeeze(qval,dim=-1)
 
+class EnsembleQnet(nn.Module):
+    # Qnet E개를 (E, in, out) weight로 쌓아서 batched matmul 한번에 계산. 출력은 (E, B) 또는 action이 (B, N, a_dim)이면 (E, B, N)
+    def __init__(self, o_dim, a_dim, h_size=256, ensemble_size=2):
+        super(EnsembleQnet,self).__init__()
+        self.o_dim, self.a_dim = o_dim, a_dim
+        self.ensemble_size = ensemble_size
+        self.autocast_dtype = None
+        self.w1 = nn.Parameter(torch.empty(ensemble_size, o_dim + a_dim, h_size))
+        self.b1 = nn.Parameter(torch.empty(ensemble_size, 1, h_size))
+        self.w2 = nn.Parameter(torch.empty(ensemble_size, h_size, h_size))
+        self.b2 = nn.Parameter(torch.empty(ensemble_size, 1, h_size))
+        self.w3 = nn.Parameter(torch.empty(ensemble_size, h_size, 1))
+        self.b3 = nn.Parameter(torch.empty(ensemble_size, 1, 1))
+        # member마다 nn.Linear 기본 init 그대로
+        self.load_qnet_state_dicts([Qnet(o_dim, a_dim, h_size).state_dict() for _ in range(ensemble_size)])
+
+    def load_qnet_state_dicts(self, state_dicts):
+        # Qnet checkpoint ({'q1': ..., 'q2': ...})를 member로
+        with torch.no_grad():
+            for i, state_dict in enumerate(state_dicts):
+                for n, layer in enumerate(('fc1', 'fc2', 'fc3'), 1):
+                    getattr(self, 'w%d' % n)[i].copy_(state_dict[layer + '.weight'].t())
+                    getattr(self, 'b%d' % n)[i, 0].copy_(state_dict[layer + '.bias'])
+
+    def qnet_state_dict(self, i):
+        # member i를 Qnet state_dict 형식으로 (저장 형식 유지용)
+        state_dict = {}
+        for n, layer in enumerate(('fc1', 'fc2', 'fc3'), 1):
+            state_dict[layer + '.weight'] = getattr(self, 'w%d' % n)[i].detach().t().clone()
+            state_dict[layer + '.bias'] = getattr(self, 'b%d' % n)[i, 0].detach().clone()
+        return state_dict
+
+    def forward(self,o_input:torch.Tensor,a_input:torch.Tensor):
+        multiple_actions = a_input.ndim == 3 and o_input.ndim == 2
+        with autocast(o_input, self.autocast_dtype):
+            if multiple_actions:
+                # obs projection은 state당 한번 (Qnet.forward와 같음), (E, B, N, h) -> (E, B*N, h)
+                batch_size, n_actions = a_input.shape[0], a_input.shape[1]
+                layer = first_layer_multi_action(o_input, a_input, self.w1, self.b1)
+                layer = torch.relu(layer.reshape(self.ensemble_size, batch_size * n_actions, -1))
+            else:
+                inputs = torch.concat([o_input,a_input],dim=-1)
+                layer = torch.relu(torch.matmul(inputs, self.w1) + self.b1)
+            layer = torch.relu(torch.baddbmm(self.b2, layer, self.w2))
+            qval  = torch.baddbmm(self.b3, layer, self.w3)
+        # loss, logsumexp는 float32로
+        qval  = torch.squeeze(qval.float(),dim=-1)
+        if multiple_actions:
+            qval = qval.reshape(self.ensemble_size, batch_size, n_actions)
+        return qval
+
 class Det_Policy(nn.Module):
     def __init__(self,o_dim,a_dim, h_size=256):
         super(Det_Policy,self).__init__()
@@ -94,13 +203,17 @@ class Det_Policy(nn.Module):
         self.relu1 = nn.ReLU()
         self.relu2 = nn.ReLU()
         self.tanh  = nn.Tanh()
+        self.autocast_dtype = None
 
     def forward(self,o_input:torch.Tensor,repeat=None):
+        with autocast(o_input, self.autocast_dtype):
+            layer = self.relu1(self.fc1(o_input))
+            layer = self.relu2(self.fc2(layer))
+            action  = self.fc3(layer)
+        action  = self.tanh(action.float())
         if repeat is not None:
-            o_input = extend_and_repeat(o_input, 1, repeat)
-        layer = self.relu1(self.fc1(o_input))
-        layer = self.relu2(self.fc2(layer))
-        action  = self.tanh(self.fc3(layer))
+            # deterministic이라 repeat개가 모두 같음 -> 계산은 state당 한번, (B, repeat, a_dim)은 view
+            action = repeat_view(action, 1, repeat)
         return action
 
 
@@ -110,6 +223,24 @@ def extend_and_repeat(tensor, dim, repeat):
     ones_shape[dim] = repeat
     return torch.unsqueeze(tensor, dim) * tensor.new_ones(ones_shape)
 
+def repeat_view(tensor, dim, repeat):
+    # extend_and_repeat과 같은 shape이지만 복사 없이 expand view로 (in-place로 쓰면 안됨)
+    shape = list(tensor.shape)
+    shape.insert(dim, repeat)
+    return torch.unsqueeze(tensor, dim).expand(shape)
+
+LOG_2 = math.log(2.0)
+HALF_LOG_2PI = 0.5 * math.log(2.0 * math.pi)
+
+def tanh_gaussian(mu, log_sigma, noise):
+    # Normal(mu, exp(log_sigma))의 reparameterized sample (mu + sigma * noise)에 tanh, log prob을 Distribution 없이 한번에.
+    # Normal log prob = -noise^2/2 - log_sigma - log(2pi)/2,
+    # tanh 보정 log(1 - tanh(u)^2) = 2 * (log2 - u - softplus(-2u)) (1e-10 없이도 |u|가 커도 안정)
+    samples = mu + torch.exp(log_sigma) * noise
+    actions = torch.tanh(samples)
+    log_probs = (-0.5 * noise**2 - log_sigma - HALF_LOG_2PI - 2 * (LOG_2 - samples - F.softplus(-2 * samples))).sum(-1)
+    return actions, log_probs
+
 class Policy(nn.Module):
     def __init__(self, o_dim, a_dim, h_size=256):
         super(Policy, self).__init__()
@@ -124,25 +255,21 @@ class Policy(nn.Module):
         self.fc3_mu = nn.Linear(h_size, a_dim)
         self.fc3_log_sigma = nn.Linear(h_size, a_dim)
         self.Tanh = nn.Tanh()
+        self.autocast_dtype = None
 
     def forward(self,o_input, eval=False, repeat=None):
+        with autocast(o_input, self.autocast_dtype):
+            layer = self.relu1(self.fc1(o_input))
+            layer = self.relu2(self.fc2(layer))
+            mu,log_sigma  = self.fc3_mu(layer), self.fc3_log_sigma(layer)
+        # sampling, log prob은 float32로
+        mu,log_sigma  = mu.float(), log_sigma.float()
         if repeat is not None:
-            o_input = extend_and_repeat(o_input, 1, repeat)
-        layer = self.relu1(self.fc1(o_input))
-        layer = self.relu2(self.fc2(layer))
-        mu,log_sigma  = self.fc3_mu(layer), self.fc3_log_sigma(layer)
-        sigma = torch.exp(torch.clip(log_sigma,self.LOG_SIG_MIN,self.LOG_SIG_MAX))
-        dist  = Normal(mu,sigma)
-        if eval:
-            samples = mu
-        else:
-            samples = dist.rsample()
-
-        actions = self.Tanh(samples)
-        log_probs = dist.log_prob(samples).sum(axis=-1)
-
-        log_probs -= torch.sum(torch.log(1 - actions**2 + 1e-10),axis=-1)
-        return actions, log_probs
+            # trunk는 state당 한번, sample (tanh, log prob)만 repeat개 -> (B, repeat, a_dim)
+            mu,log_sigma  = repeat_view(mu, 1, repeat), repeat_view(log_sigma, 1, repeat)
+        log_sigma = torch.clip(log_sigma,self.LOG_SIG_MIN,self.LOG_SIG_MAX)
+        noise = torch.zeros_like(mu) if eval else torch.randn_like(mu)
+        return tanh_gaussian(mu, log_sigma, noise)
 
 
 
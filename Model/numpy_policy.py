@@ -0,0 +1,35 @@
+import numpy as np
+
+# 배포용: Det_Policy / Policy의 deterministic action (Policy는 tanh(mu))을 torch 없이 numpy로.
+# torch를 import하지 않아야 하므로 Model.model 등은 import 금지.
+# .npz (export_policy.py): w1, b1, w2, b2, w3, b3 (float32, w는 (in, out))
+
+
+def policy_arrays(state_dict):
+    # Det_Policy / Policy state_dict (값은 numpy로 바꾼 것) -> .npz에 쓸 array. Policy는 mu 쪽만 (log_sigma는 안 씀)
+    layers = ('fc1', 'fc2', 'fc3_mu') if 'fc3_mu.weight' in state_dict else ('fc1', 'fc2', 'fc3')
+    arrays = {}
+    for n, layer in enumerate(layers, 1):
+        arrays['w%d' % n] = np.ascontiguousarray(np.asarray(state_dict[layer + '.weight'], dtype=np.float32).T)
+        arrays['b%d' % n] = np.asarray(state_dict[layer + '.bias'], dtype=np.float32)
+    return arrays
+
+
+def save_policy(path, state_dict):
+    np.savez_compressed(path, **policy_arrays(state_dict))
+
+
+class NumpyPolicy:
+    # o: (o_dim,) 또는 (..., o_dim) -> action (a_dim,) / (..., a_dim), [-1, 1]
+    def __init__(self, path):
+        with np.load(path) as arrays:
+            self.w1, self.b1 = arrays['w1'], arrays['b1']
+            self.w2, self.b2 = arrays['w2'], arrays['b2']
+            self.w3, self.b3 = arrays['w3'], arrays['b3']
+        self.o_dim, self.a_dim = self.w1.shape[0], self.w3.shape[1]
+
+    def __call__(self, o):
+        x = np.asarray(o, dtype=np.float32)
+        layer = np.maximum(x @ self.w1 + self.b1, 0)
+        layer = np.maximum(layer @ self.w2 + self.b2, 0)
+        return np.tanh(layer @ self.w3 + self.b3)
@@ -1,13 +1,16 @@
 import gym
 from Model.class_model import SAC_CQL_Agent
 from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
 import numpy as np
 import torch
 import d4rl
-from Utils.utils import d4rl_dataset
+from Utils.utils import d4rl_dataset, dataset_kwargs
+from Utils.prefetch import Prefetcher
 
 
 args = get_args()
+configure_threads(args, 'SAC_CQL')
 
 # env = gym.make("InvertedPendulum-v2")
 env = gym.make("halfcheetah-random-v2")
@@ -18,7 +21,11 @@ epi_length = env.spec.max_episode_steps
 
 
 agent = SAC_CQL_Agent(state_dim,action_dim,args)
-dataset = d4rl_dataset(env.unwrapped)
+dataset = d4rl_dataset(env.unwrapped, **dataset_kwargs(args))
+if args.prefetch > 0:
+  batches = Prefetcher(dataset.get_data, num_prefetch=args.prefetch, device=args.device_train)
+else:
+  batches = iter(dataset.get_data, None)
 
 
 
@@ -31,33 +38,38 @@ n_random = 1000
 n_train_step_per_epoch=1000
 
 
-while local_step <=maximum_step:
-  state = env.reset()
-  for step in range(n_train_step_per_epoch):
-    batch = dataset.get_data()
-    local_step += 1
-    agent.train(batch)
-  episode_step += 1
-
-  # Evaluation
-  if episode_step % eval_period == 0:
+try:
+  while local_step <=maximum_step:
     state = env.reset()
-    total_reward = 0
-    for step in range(epi_length):
-      # env.render()
-      action = agent.select_action(state.reshape([1,-1]),eval=True)
-      next_state, rwd, done, _ = env.step(action*action_max)
-      total_reward += rwd
-      state = next_state
-      if done:
-        break
-    print("[EPI%d] : %.2f"%(episode_step, total_reward))
+    for step in range(n_train_step_per_epoch):
+      batch = next(batches)
+      local_step += 1
+      agent.train(batch)
+    episode_step += 1
+
+    # Evaluation
+    if episode_step % eval_period == 0:
+      state = env.reset()
+      total_reward = 0
+      for step in range(epi_length):
+        # env.render()
+        action = agent.select_action(state.reshape([1,-1]),eval=True)
+        next_state, rwd, done, _ = env.step(action*action_max)
+        total_reward += rwd
+        state = next_state
+        if done:
+          break
+      print("[EPI%d] : %.2f"%(episode_step, total_reward))
 
-  # if episode_step % 200 == 199:
-  #   torch.save({'policy': agent.pi.state_dict(),
-  #               'Q_val1': agent.q1.state_dict(),
-  #               'Q_val2': agent.q2.state_dict()
-  #               }, "./model_save/sac-cql/SAC-CQL_model_" + str(episode_step + 1) + ".pt")
+    # if episode_step % 200 == 199:
+    #   torch.save({'policy': agent.pi.state_dict(),
+    #               'Q_val1': agent.q1.state_dict(),
+    #               'Q_val2': agent.q2.state_dict()
+    #               }, "./model_save/sac-cql/SAC-CQL_model_" + str(episode_step + 1) + ".pt")
+finally:
+  # Ctrl-C나 에러로 끝나도 prefetch thread 정리
+  if args.prefetch > 0:
+    batches.close()
 
 
 
@@ -1,10 +1,13 @@
 import gym
 from Model.class_model import SAC_Agent
 from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
+from Utils.precision import format_errors
 import numpy as np
 import torch
 
 args = get_args()
+configure_threads(args, 'SAC_CQL')
 
 # env = gym.make("InvertedPendulum-v2")
 env = gym.make("HalfCheetah-v2")
@@ -58,11 +61,13 @@ while local_step <=maximum_step:
       if done:
         break
     print("[EPI%d] : %.2f"%(episode_step, total_reward))
+    if args.storage != 'float32':
+      print("[storage] %s max quantization error : %s"%(args.storage, format_errors(agent.buffer.quantization_error())))
 
   if episode_step % 200 == 199:
     torch.save({'policy': agent.pi.state_dict(),
-                'Q_val1': agent.q1.state_dict(),
-                'Q_val2': agent.q2.state_dict()
+                'Q_val1': agent.q.qnet_state_dict(0),
+                'Q_val2': agent.q.qnet_state_dict(1)
                 }, "./model_save/sac/SAC_model_" + str(episode_step + 1) + ".pt")
 
 
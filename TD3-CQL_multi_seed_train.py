@@ -0,0 +1,70 @@
+import gym
+from Model.class_model import MultiSeed_TD3_Agent
+from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
+import numpy as np
+import torch
+import d4rl
+from Utils.utils import d4rl_dataset, dataset_kwargs
+from Utils.prefetch import Prefetcher
+
+# TD3-CQL_train.py를 --seeds의 seed들로 한 process에서 (dataset은 한번만 올리고 update는 vmap으로 같이)
+# python TD3-CQL_multi_seed_train.py --seeds 0 1 2 3 4
+
+args = get_args()
+configure_threads(args, 'TD3')
+
+envs = [gym.make(args.task_name) for _ in args.seeds]
+for env, seed in zip(envs, args.seeds):
+  env.seed(seed)
+env = envs[0]
+state_dim = env.observation_space.shape[0]
+action_dim = env.action_space.shape[0]
+action_max = env.action_space.high[0]
+epi_length = env.spec.max_episode_steps
+
+
+agent = MultiSeed_TD3_Agent(state_dim,action_dim,args,args.seeds)
+dataset = d4rl_dataset(env.unwrapped, **dataset_kwargs(args))
+if args.prefetch > 0:
+  batches = Prefetcher(lambda: agent.sample(dataset), num_prefetch=args.prefetch, device=args.device_train)
+else:
+  batches = iter(lambda: agent.sample(dataset), None)
+
+maximum_step = 1000000
+local_step = 0
+eval_period = 5
+episode_step = 0
+#====cql====
+n_train_step_per_epoch=1000
+
+
+try:
+  while local_step <=maximum_step:
+    for step in range(n_train_step_per_epoch):
+      batch = next(batches)
+      local_step += 1
+      agent.train_off(batch,cql=True)
+    episode_step += 1
+
+    # Evaluation: seed마다 자기 env에서 episode 하나, 끝난 env는 멈춤
+    if episode_step % eval_period == 0:
+      states = np.stack([env.reset() for env in envs])
+      total_rewards = np.zeros(len(envs))
+      running = np.ones(len(envs), dtype=bool)
+      for step in range(epi_length):
+        actions = agent.select_action(states,eval=True)
+        for i, env in enumerate(envs):
+          if not running[i]:
+            continue
+          next_state, rwd, done, _ = env.step(actions[i]*action_max)
+          total_rewards[i] += rwd
+          states[i] = next_state
+          running[i] = not done
+        if not running.any():
+          break
+      print("[EPI%d] : %s (mean %.2f)"%(episode_step, " ".join("%.2f" % r for r in total_rewards), total_rewards.mean()))
+finally:
+  # Ctrl-C나 에러로 끝나도 prefetch thread 정리
+  if args.prefetch > 0:
+    batches.close()
@@ -1,14 +1,16 @@
 import gym
 from Model.class_model import TD3_Agent
 from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
 import numpy as np
 import torch
 import d4rl
-from Utils.utils import d4rl_dataset
+from Utils.utils import d4rl_dataset, dataset_kwargs
 
 import matplotlib.pyplot as plt
 
 args = get_args()
+configure_threads(args, 'TD3')
 
 # env = gym.make("InvertedPendulum-v2")
 env = gym.make("halfcheetah-expert-v2")
@@ -24,7 +26,7 @@ agent.init_q("./model_save/bc_q/bc_q100000.pt")
 BC_test = TD3_Agent(state_dim,action_dim,args)
 BC_test.init_pi("./model_save/bc/bc_policy50.pt")
 
-dataset = d4rl_dataset(env.unwrapped)
+dataset = d4rl_dataset(env.unwrapped, **dataset_kwargs(args))
 
 maximum_step = 1000000
 local_step = 0
@@ -65,7 +67,7 @@ while local_step <=maximum_step:
   # action_batch = torch.cat((action_pi,action_data,action_rand),dim=0)
   # print(action_batch)
   # print(agent.q1(state_batch,action_batch))
-  plt.plot(agent.q1(state_batch,action_batch).cpu().detach().numpy())
+  plt.plot(agent.q(state_batch,action_batch)[0].cpu().detach().numpy())
   plt.show()
   # raise
 
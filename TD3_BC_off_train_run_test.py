@@ -1,14 +1,16 @@
 import gym
 from Model.class_model import TD3_Agent
 from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
 import numpy as np
 import torch
 import d4rl
-from Utils.utils import d4rl_dataset
+from Utils.utils import d4rl_dataset, dataset_kwargs
 
 import matplotlib.pyplot as plt
 
 args = get_args()
+configure_threads(args, 'TD3')
 
 # env = gym.make("InvertedPendulum-v2")
 env = gym.make("halfcheetah-medium-expert-v2")
@@ -21,7 +23,7 @@ agent = TD3_Agent(state_dim,action_dim,args)
 agent.init_pi("./model_save/bc/bc_policy50.pt")
 agent.init_q("./model_save/bc_q/bc_q_cql100000.pt")
 
-dataset = d4rl_dataset(env.unwrapped)
+dataset = d4rl_dataset(env.unwrapped, **dataset_kwargs(args))
 
 maximum_step = 1000000
 local_step = 0
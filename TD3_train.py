@@ -1,10 +1,14 @@
+import os
 import gym
 from Model.class_model import TD3_Agent
 from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
+from Utils.precision import format_errors
 import numpy as np
 import torch
 
 args = get_args()
+configure_threads(args, 'TD3')
 
 # env = gym.make("InvertedPendulum-v2")
 env = gym.make("HalfCheetah-v2")
@@ -22,6 +26,19 @@ eval_num = 5
 episode_step = 0
 n_random = 10000
 
+if args.buffer_snapshot_dir is not None and os.path.isfile(os.path.join(args.buffer_snapshot_dir, 'header.json')):
+  # 죽은 run 이어하기: buffer와 agent (network, target, optimizer)를 복구하고 step 수도 이어서
+  # header.json과 agent.pt는 따로 쓰므로 둘 사이에 죽었으면 step 수 (tags)가 다름 -> 그때는 agent.pt를 안 씀
+  tags = agent.buffer.load_snapshot(args.buffer_snapshot_dir).get('tags', {})
+  agent_file = os.path.join(args.buffer_snapshot_dir, 'agent.pt')
+  if os.path.isfile(agent_file):
+    try:
+      checkpoint = agent.load_checkpoint(agent_file, **tags)
+      local_step, episode_step = checkpoint['local_step'], checkpoint['episode_step']
+    except ValueError as e:
+      print("[resume] buffer only:", e)
+  # agent.pt가 없거나 buffer와 안 맞으면 buffer만 복구: local_step은 0 그대로 두어 random action warmup부터 다시
+
 
 while local_step <=maximum_step:
   state = env.reset()
@@ -46,6 +63,11 @@ while local_step <=maximum_step:
       break
   episode_step += 1
 
+  if args.buffer_snapshot_dir is not None and episode_step % args.snapshot_period == 0:
+    tags = dict(local_step=local_step, episode_step=episode_step, update_count=agent.update_count)
+    agent.buffer.save_snapshot(args.buffer_snapshot_dir, **tags)
+    agent.save_checkpoint(os.path.join(args.buffer_snapshot_dir, 'agent.pt'), local_step=local_step, episode_step=episode_step)
+
   # =====Evaluation=====
   if episode_step % eval_period == 0:
     epi_return = [] #나중에 success까지 포함해야할듯
@@ -64,6 +86,8 @@ while local_step <=maximum_step:
     print("==================[Eval]====================")
     print("Epi : ", episode_step)
     print("Mean return  : ", np.mean(epi_return),"Min return",np.min(epi_return),"Max return",np.max(epi_return))
+    if args.storage != 'float32':
+      print("Max quantization error (%s) : "%args.storage, format_errors(agent.buffer.quantization_error()))
 
   # if episode_step % 200 == 199:
   #   torch.save({'policy': agent.pi.state_dict(),
@@ -6,6 +6,21 @@ def get_args():
 
     parser.add_argument('--device_eval',  default="cpu")
     parser.add_argument('--device_train', default="cuda")
+    parser.add_argument('--dataset_cache_dir', default=None, help="d4rl dataset를 .npy로 저장/mmap으로 재사용할 폴더")
+    parser.add_argument('--prefetch', type=int, default=0, help="background thread에서 미리 준비해둘 batch 수 (0이면 안씀)")
+    parser.add_argument('--prioritized', action='store_true', help="Buffer, d4rl_dataset에서 TD error 기반 prioritized sampling")
+    parser.add_argument('--storage', default="float32", choices=["float32", "float16", "bfloat16"], help="Buffer, d4rl_dataset의 obs/action 저장 형식")
+    parser.add_argument('--epoch_shuffle', default=None, choices=["copy", "block"], help="d4rl_dataset을 epoch 단위로 섞어서 연속 slice로 batch (copy: 전체 복사, block: batch block 순서만)")
+    parser.add_argument('--dataset_seed', type=int, default=None)
+    parser.add_argument('--nstep', type=int, default=1, help="d4rl_dataset에서 n-step TD target (SAC_gamma로 미리 계산)")
+    parser.add_argument('--dataset_on_device', action='store_true', help="dataset 전체를 device_train에 올리고 batch sampling도 device에서")
+    parser.add_argument('--compile', action='store_true', help="agent update를 torch.compile로 (안되면 eager)")
+    parser.add_argument('--compile_sac_cql', action='store_true', help="SAC_CQL update를 torch.compile로 (--compile은 SAC_CQL에 적용 안함, 측정상 더 느림)")
+    parser.add_argument('--num_threads', type=int, default=None, help="torch intra-op thread 수 (지정하면 autotune 안함)")
+    parser.add_argument('--num_interop_threads', type=int, default=None, help="torch inter-op thread 수 (지정하면 autotune 안함)")
+    parser.add_argument('--autotune_threads', action='store_true', help="CPU에서 thread 수를 update 시간으로 골라서 thread_tuning_file에 저장/재사용")
+    parser.add_argument('--thread_tuning_file', default="./thread_tuning.json")
+    parser.add_argument('--autocast', default=None, choices=["bfloat16"], help="critic, actor forward를 autocast로 (weight, log_alpha, logsumexp, log prob은 float32)")
 
     # ===================SAC hyperparameter======================
     parser.add_argument('--SAC_gamma', type=float, default=0.99) #TD3 공용
@@ -15,15 +30,30 @@ def get_args():
     parser.add_argument('--SAC_hidden_size', type=int, default=256)  #TD3 공용
     parser.add_argument('--SAC_batch_size', type=int, default=128)   #TD3 공용
     parser.add_argument('--SAC_train_start', type=int, default=10000) #TD3 공용
+    parser.add_argument('--buffer_snapshot_dir', default=None, help="Buffer snapshot 폴더, 있으면 시작할 때 복구") #TD3 공용
+    parser.add_argument('--snapshot_period', type=int, default=50, help="몇 episode마다 Buffer snapshot") #TD3 공용
+    parser.add_argument('--compact_buffer', action='store_true', help="Buffer에서 next obs를 따로 저장하지 않음 (obs 메모리 절반)") #TD3 공용
+    parser.add_argument('--critic_ensemble_size', type=int, default=2, help="ensemble critic의 Q 개수 (target은 member들의 min)") #TD3 공용
 
 
     #====================TD3 hyperparameter======================
     parser.add_argument('--update_pi_ratio', type=int, default=250000)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3, 4], help="multi-seed 학습 (MultiSeed_TD3_Agent)에서 같이 돌릴 seed들")
 
     #===================BCO hyperparameter=======================
     parser.add_argument('--BC_lr', type=float, default=3e-4, help="3e-4")
     parser.add_argument('--BC_hidden_size', type=int, default=256)
 
+    #===================export_policy.py=========================
+    parser.add_argument('--policy_checkpoint', default=None, help="{'policy': state_dict} checkpoint (.pt)")
+    parser.add_argument('--export_path', default=None, help="numpy policy (.npz), 없으면 checkpoint 이름으로")
+
+    #===================benchmark.py=============================
+    parser.add_argument('--benchmark', default="cql_policy", choices=["cql_policy", "compile", "autocast", "multi_seed", "multi_seed_parity", "select_action"])
+    parser.add_argument('--benchmark_agent', default="SAC_CQL", choices=["SAC", "SAC_CQL", "TD3", "BC"])
+    parser.add_argument('--benchmark_steps', type=int, default=200)
+    parser.add_argument('--benchmark_eval_episodes', type=int, default=0, help="autocast: >0이면 task_name dataset으로 학습한 뒤 평가 return도 비교 (gym, d4rl 필요)")
+
 
 
     args = parser.parse_args()
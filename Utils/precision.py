@@ -0,0 +1,42 @@
+import numpy as np
+
+
+# obs, action 저장 형식. numpy엔 bfloat16이 없어서 float32의 상위 16bit를 uint16으로 저장
+STORAGE_DTYPES = dict(float32=np.float32, float16=np.float16, bfloat16=np.uint16)
+
+
+def storage_dtype(storage):
+    if storage not in STORAGE_DTYPES:
+        raise ValueError("unknown storage: " + str(storage))
+    return STORAGE_DTYPES[storage]
+
+
+def done_dtype(storage):
+    # float32가 아니면 done은 uint8로
+    return np.float32 if storage == 'float32' else np.uint8
+
+
+def encode(x, storage):
+    x = np.asarray(x, dtype=np.float32)
+    if storage == 'bfloat16':
+        # round to nearest even
+        bits = np.ascontiguousarray(x).view(np.uint32)
+        bits = bits + (np.uint32(0x7FFF) + ((bits >> 16) & 1))
+        return (bits >> 16).astype(np.uint16)
+    return x.astype(storage_dtype(storage), copy=False)
+
+
+def decode(x, storage):
+    if storage == 'bfloat16':
+        return (np.asarray(x).astype(np.uint32) << 16).view(np.float32)
+    return np.asarray(x, dtype=np.float32)
+
+
+def quantization_error(fields, storage):
+    # float32 field들 (dict)을 storage로 저장했다 읽었을 때 field별 최대 절대 오차
+    return {key: float(np.max(np.abs(decode(encode(value, storage), storage) - np.asarray(value, dtype=np.float32)), initial=0.0))
+            for key, value in fields.items()}
+
+
+def format_errors(errors):
+    return ", ".join("%s %.3g" % (key, value) for key, value in errors.items())
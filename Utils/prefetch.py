@@ -0,0 +1,80 @@
+import queue
+import threading
+import numpy as np
+import torch
+
+
+def batch_to_tensor(batch, device=None, pin_memory=False):
+    tensors = []
+    for x in batch:
+        if isinstance(x, dict):
+            # prioritized sampling의 idx, weights 등은 그대로 넘김
+            tensors.append(x)
+            continue
+        if not isinstance(x, torch.Tensor):
+            x = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+        x = x.contiguous()
+        if pin_memory and x.device.type == 'cpu':
+            x = x.pin_memory()
+        if device is not None:
+            x = x.to(device, non_blocking=pin_memory)
+        tensors.append(x)
+    return tuple(tensors)
+
+
+class Prefetcher:
+    # sample_fn (d4rl_dataset.get_data, Buffer.random_batch ...)을 background thread에서 미리 num_prefetch개 뽑아서
+    # contiguous (pinned) tensor로 바꿔두는 iterator.
+    # Buffer에 쓰면서 동시에 돌리면 batch가 최대 num_prefetch step만큼 오래된 buffer에서 뽑힘
+    def __init__(self, sample_fn, num_prefetch=4, device=None, pin_memory=None):
+        self.sample_fn = sample_fn
+        self.device = device
+        if pin_memory is None:
+            pin_memory = device is not None and torch.device(device).type == 'cuda'
+        self.pin_memory = pin_memory
+        self.queue = queue.Queue(maxsize=num_prefetch)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        try:
+            while not self.stop_event.is_set():
+                batch = batch_to_tensor(self.sample_fn(), self.device, self.pin_memory)
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            # 에러는 main thread의 next()에서 다시 raise
+            self.queue.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stop_event.is_set():
+            raise StopIteration
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            self.close()
+            raise batch
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        # worker가 put에서 막혀있지 않도록 queue를 비워줌
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class SumTree:
+    # array 기반 sum tree. tree[1]이 root, leaf i는 tree[leaf_start + i].
+    # update / find 모두 batch 단위로 level마다 numpy 연산 한번씩 -> O(batch * log N), python loop는 depth만큼만
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = max(int(np.ceil(np.log2(max(capacity, 2)))), 1)
+        self.leaf_start = 1 << self.depth
+        self.tree = np.zeros(2 * self.leaf_start, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[np.asarray(idx) + self.leaf_start]
+
+    def update(self, idx, values):
+        pos = np.asarray(idx, dtype=np.int64) + self.leaf_start
+        self.tree[pos] = values
+        # parent가 겹쳐도 같은 값을 다시 쓰는 것뿐이라 unique 필요 없음
+        for _ in range(self.depth):
+            pos = pos // 2
+            self.tree[pos] = self.tree[2 * pos] + self.tree[2 * pos + 1]
+
+    def find(self, values):
+        # prefix sum이 values가 되는 leaf를 batch로 찾음
+        values = np.array(values, dtype=np.float64)
+        pos = np.ones(values.shape[0], dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * pos
+            left_sum = self.tree[left]
+            right_sum = self.tree[left + 1]
+            # 부동소수 오차로 priority 0인 leaf (빈 칸, 지운 row)에 떨어지지 않도록
+            go_right = ((values > left_sum) & (right_sum > 0)) | (left_sum <= 0)
+            values -= left_sum * go_right
+            pos = left + go_right
+        return pos - self.leaf_start
+
+
+class PrioritizedSampler:
+    # Prioritized Experience Replay (Schaul et al. 2016), proportional variant.
+    # P(i) = p_i^alpha / sum p^alpha, importance weight = (N * P(i))^-beta / max
+    def __init__(self, capacity, alpha=0.6, beta=0.4, eps=1e-6):
+        self.tree = SumTree(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.max_priority = 1.0
+
+    def add(self, idx):
+        # 새로 들어온 transition은 한번은 뽑히도록 max priority로
+        idx = np.atleast_1d(idx)
+        self.tree.update(idx, np.full(idx.shape[0], self.max_priority ** self.alpha))
+
+    def remove(self, idx):
+        idx = np.atleast_1d(idx)
+        self.tree.update(idx, np.zeros(idx.shape[0]))
+
+    def sample(self, batch_size, n):
+        # stratified: [0, total)을 batch_size 구간으로 나눠서 구간마다 하나씩
+        total = self.tree.total()
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * (total / batch_size)
+        idx = self.tree.find(values)
+        probs = self.tree.get(idx) / total
+        weights = (n * probs) ** (-self.beta)
+        weights /= weights.max()
+        return idx, weights.astype(np.float32)
+
+    def update(self, idx, priorities):
+        priorities = np.abs(np.asarray(priorities, dtype=np.float64)) + self.eps
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(idx, priorities ** self.alpha)
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import sys
+import socket
+import argparse
+import subprocess
+from copy import copy
+import numpy as np
+import torch
+
+
+# CPU에서 torch intra-op / inter-op thread 수를 정함.
+# --num_threads, --num_interop_threads가 있으면 그대로, --autotune_threads면 후보 setting마다 agent update 시간을 재서
+# 가장 빠른 것을 (hostname, hidden_size, batch_size)별로 thread_tuning_file에 저장해두고 다음부터는 읽어서 씀.
+# interop thread 수는 process에서 한번만 정할 수 있어서 후보마다 새 python process에서 잼
+# (multiprocessing spawn은 __main__ guard 없는 *_train.py를 다시 실행하므로 python -m Utils.thread_tuning으로)
+
+def candidate_settings():
+    n_cpu = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    threads = sorted({n for n in (1, 2, 4, 8, 16, 32, 64) if n <= n_cpu} | {n_cpu})
+    return [(num_threads, num_interop_threads) for num_threads in threads for num_interop_threads in (1, 2)]
+
+
+def tuning_key(args):
+    return "%s/hidden%d/batch%d" % (socket.gethostname(), args.SAC_hidden_size, args.SAC_batch_size)
+
+
+def time_updates(args, agent_name, num_threads, num_interop_threads, steps=20, warmup=5):
+    # update 한번 평균 시간 (sec). 새 process에서 torch를 다른 곳에서 쓰기 전에 불러야 함
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(num_interop_threads)
+    from Model.class_model import SAC_CQL_Agent, TD3_Agent
+    o_dim, a_dim, batch_size = 17, 6, args.SAC_batch_size
+    if agent_name == 'TD3':
+        agent = TD3_Agent(o_dim, a_dim, args)
+        step_fn = lambda batch: agent.train_off(batch, cql=True)
+    else:
+        agent = SAC_CQL_Agent(o_dim, a_dim, args)
+        step_fn = agent.train
+    batches = [(np.random.randn(batch_size, o_dim).astype(np.float32),
+                np.random.uniform(-1, 1, (batch_size, a_dim)).astype(np.float32),
+                np.random.randn(batch_size).astype(np.float32),
+                np.random.randn(batch_size, o_dim).astype(np.float32),
+                np.zeros(batch_size, dtype=np.float32)) for _ in range(warmup + steps)]
+    for batch in batches[:warmup]:
+        step_fn(batch)
+    start = time.perf_counter()
+    for batch in batches[warmup:]:
+        step_fn(batch)
+    return (time.perf_counter() - start) / steps
+
+
+def autotune(args, agent_name='SAC_CQL'):
+    # 후보 setting마다 process 하나씩, 가장 빠른 (num_threads, num_interop_threads)
+    tune_args = copy(args)
+    tune_args.device_train = 'cpu'
+    tune_args.compile = False
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    step_times = {}
+    for setting in candidate_settings():
+        output = subprocess.run([sys.executable, '-m', 'Utils.thread_tuning', json.dumps(vars(tune_args)), agent_name,
+                                 str(setting[0]), str(setting[1])], cwd=root, check=True, stdout=subprocess.PIPE, text=True).stdout
+        step_times[setting] = float(output.split()[-1])
+        print("[thread tuning] threads %d, interop %d : %.2f ms/update" % (setting + (step_times[setting] * 1000,)))
+    return min(step_times, key=step_times.get)
+
+
+def load_tuning(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_tuning(path, key, setting):
+    # 같은 machine의 다른 run이 동시에 쓸 수 있으므로 다시 읽어서 합치고 rename으로 교체
+    tuning = load_tuning(path)
+    tuning[key] = dict(num_threads=setting[0], num_interop_threads=setting[1])
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(tuning, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def configure_threads(args, agent_name='SAC_CQL'):
+    # script 시작할 때 (agent 만들기 전에) 호출. agent_name: autotune에서 시간을 잴 agent ('SAC_CQL', 'TD3')
+    num_threads, num_interop_threads = args.num_threads, args.num_interop_threads
+    if num_threads is None and num_interop_threads is None and args.autotune_threads \
+            and torch.device(args.device_train).type == 'cpu':
+        key = tuning_key(args)
+        tuning = load_tuning(args.thread_tuning_file)
+        if key not in tuning:
+            save_tuning(args.thread_tuning_file, key, autotune(args, agent_name))
+            tuning = load_tuning(args.thread_tuning_file)
+        num_threads, num_interop_threads = tuning[key]['num_threads'], tuning[key]['num_interop_threads']
+    # interop은 parallel 작업이 시작되기 전에 한번만 정할 수 있음
+    if num_interop_threads is not None and torch.get_num_interop_threads() != num_interop_threads:
+        torch.set_num_interop_threads(num_interop_threads)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    return num_threads, num_interop_threads
+
+
+if __name__ == '__main__':
+    # autotune의 후보 하나: python -m Utils.thread_tuning <args json> <agent_name> <num_threads> <num_interop_threads>
+    print(time_updates(argparse.Namespace(**json.loads(sys.argv[1])), sys.argv[2], int(sys.argv[3]), int(sys.argv[4])))
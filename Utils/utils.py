@@ -1,21 +1,325 @@
+import os
+import json
+import shutil
+import tempfile
 import d4rl
 import numpy as np
+import torch
+from Utils.sum_tree import PrioritizedSampler
+from Utils.precision import encode, decode, quantization_error, format_errors
+
+
+DATASET_FIELDS = ('observations', 'actions', 'next_observations', 'rewards', 'dones')
+CACHE_FORMAT = 1
+NSTEP_FIELDS = ('rewards', 'next_idx', 'dones', 'discounts')
+
+
+def dataset_cache_path(cache_dir, env, task_name=None):
+    # <cache_dir>/<task name>/<dataset version>, version = hdf5 file name d4rl downloads the task from
+    if task_name is None:
+        spec = getattr(env, 'spec', None)
+        task_name = spec.id if spec is not None else type(env).__name__
+    dataset_url = getattr(env, 'dataset_url', None)
+    version = os.path.splitext(os.path.basename(dataset_url))[0] if dataset_url else 'local'
+    return os.path.join(cache_dir, task_name, version)
+
+
+def load_cached_dataset(path):
+    meta_file = os.path.join(path, 'meta.json')
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta.get('format') != CACHE_FORMAT:
+        return None
+    dataset = {key: np.load(os.path.join(path, key + '.npy'), mmap_mode='r') for key in DATASET_FIELDS}
+    if any(dataset[key].shape[0] != meta['len'] for key in DATASET_FIELDS):
+        return None
+    return dataset
+
+
+def save_cached_dataset(path, dataset):
+    # 임시 폴더에 다 쓰고 rename -> 동시에 뜬 다른 run이 반쯤 쓰인 cache를 읽지 않음
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    try:
+        for key in DATASET_FIELDS:
+            np.save(os.path.join(tmp_path, key + '.npy'), np.ascontiguousarray(dataset[key]))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'format': CACHE_FORMAT, 'len': int(dataset['observations'].shape[0])}, f)
+        os.rename(tmp_path, path)
+    except OSError:
+        # 다른 process가 먼저 cache를 만든 경우
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if load_cached_dataset(path) is None:
+            raise
+
+
+def nstep_index(dataset, gamma, nstep):
+    # row마다 n-step 할인 보상, bootstrap할 row (그 row의 next obs로 bootstrap), 실제 할인율 gamma^k*(1-terminal)
+    # qlearning_dataset은 episode 순서대로라 next_obs[i] == obs[i+1]이고 terminal이 아니면 같은 episode (timeout도 여기서 끊김)
+    rewards = np.asarray(dataset['rewards'], dtype=np.float64)
+    terminals = np.asarray(dataset['dones']) > 0
+    N = rewards.shape[0]
+    same_episode = np.zeros(N, dtype=bool)
+    same_episode[:-1] = ~terminals[:-1] & np.all(np.asarray(dataset['next_observations'][:-1]) == np.asarray(dataset['observations'][1:]), axis=1)
+
+    returns = np.zeros(N, dtype=np.float64)
+    next_idx = np.arange(N)
+    steps = np.zeros(N, dtype=np.int64)
+    alive = np.ones(N, dtype=bool)
+    j = np.arange(N)
+    for k in range(nstep):
+        returns += alive * gamma**k * rewards[j]
+        next_idx = np.where(alive, j, next_idx)
+        steps += alive
+        alive &= same_episode[j]
+        j = np.minimum(j + 1, N - 1)
+    dones = terminals[next_idx]
+    discounts = gamma**steps * (1 - dones)
+    return dict(rewards=returns.astype(np.float32), next_idx=next_idx, dones=dones.astype(np.float32), discounts=discounts.astype(np.float32))
+
+
+def load_nstep_index(dataset, gamma, nstep, cache_path=None):
+    # dataset/gamma/n마다 한번 계산해서 cache 폴더에 저장
+    if cache_path is None:
+        return nstep_index(dataset, gamma, nstep)
+    path = os.path.join(cache_path, 'nstep_%d_gamma_%s' % (nstep, repr(float(gamma))))
+    if os.path.isfile(os.path.join(path, 'discounts.npy')):
+        return {key: np.load(os.path.join(path, key + '.npy'), mmap_mode='r') for key in NSTEP_FIELDS}
+    index = nstep_index(dataset, gamma, nstep)
+    tmp_path = tempfile.mkdtemp(dir=cache_path, prefix='.tmp_')
+    for key in NSTEP_FIELDS:
+        np.save(os.path.join(tmp_path, key + '.npy'), index[key])
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return index
+
+
+BATCH_FIELDS = ('observations', 'actions', 'rewards', 'next_observations', 'dones')
+ENCODED_FIELDS = ('observations', 'actions', 'next_observations')
+TORCH_STORAGE = dict(float32=torch.float32, float16=torch.float16, bfloat16=torch.bfloat16)
+
+
+def load_encoded_fields(dataset, storage, cache_path=None):
+    # obs, action을 storage 형식으로 바꾼 array와 field별 최대 quantization error.
+    # cache_path가 있으면 <cache_path>/storage_<storage>/에 한번 저장해두고 mmap으로
+    if cache_path is None:
+        fields = {key: dataset[key] for key in ENCODED_FIELDS}
+        return {key: encode(value, storage) for key, value in fields.items()}, quantization_error(fields, storage)
+    path = os.path.join(cache_path, 'storage_' + storage)
+    error_file = os.path.join(path, 'quantization_error.json')
+    if not os.path.isfile(error_file):
+        tmp_path = tempfile.mkdtemp(dir=cache_path, prefix='.tmp_')
+        for key in ENCODED_FIELDS:
+            np.save(os.path.join(tmp_path, key + '.npy'), encode(dataset[key], storage))
+        with open(os.path.join(tmp_path, 'quantization_error.json'), 'w') as f:
+            json.dump(quantization_error({key: dataset[key] for key in ENCODED_FIELDS}, storage), f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    with open(error_file) as f:
+        errors = json.load(f)
+    return {key: np.load(os.path.join(path, key + '.npy'), mmap_mode='r') for key in ENCODED_FIELDS}, errors
+
+
+def dataset_kwargs(args):
+    # training script의 args -> d4rl_dataset 옵션
+    if args.prioritized:
+        sampling = 'prioritized'
+    elif args.epoch_shuffle is not None:
+        sampling = 'epoch'
+    else:
+        sampling = 'uniform'
+    return dict(cache_dir=args.dataset_cache_dir, device=args.device_train if args.dataset_on_device else None,
+                sampling=sampling, storage=args.storage, seed=args.dataset_seed, epoch_shuffle=args.epoch_shuffle or 'copy',
+                nstep=args.nstep, gamma=args.SAC_gamma)
 
 
 class d4rl_dataset():
-    def __init__(self,env):
-        dataset = d4rl.qlearning_dataset(env)
-        self.dataset = dict(
-        observations=dataset['observations'],
-        actions=dataset['actions'],
-        next_observations=dataset['next_observations'],
-        rewards=dataset['rewards'],
-        dones=dataset['terminals'].astype(np.float32),
-        )
+    def __init__(self,env,cache_dir=None,task_name=None,device=None,sampling='uniform',storage='float32',seed=None,epoch_shuffle='copy',nstep=1,gamma=0.99):
+        self.device = device
+        self.sampling = sampling
+        self.storage = storage
+        self.nstep = nstep
+        self.dataset = None
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = dataset_cache_path(cache_dir, env, task_name)
+            self.dataset = load_cached_dataset(cache_path)
+
+        if self.dataset is None:
+            dataset = d4rl.qlearning_dataset(env)
+            self.dataset = dict(
+            observations=dataset['observations'],
+            actions=dataset['actions'],
+            next_observations=dataset['next_observations'],
+            rewards=dataset['rewards'],
+            dones=dataset['terminals'].astype(np.float32),
+            )
+            if cache_dir is not None:
+                save_cached_dataset(cache_path, self.dataset)
+                self.dataset = load_cached_dataset(cache_path)
         self.len = self.dataset['observations'].shape[0]
 
+        if self.nstep > 1:
+            # n-step target: rewards, dones를 n-step 값으로 바꾸고 row별 할인율 discounts, bootstrap row index next_idx 추가.
+            # next_observations는 (mmap) 그대로 두고 sample할 때 next_observations[next_idx[idx]]로 (rows)
+            index = load_nstep_index(self.dataset, gamma, self.nstep, cache_path)
+            self.dataset = dict(self.dataset,
+                                rewards=index['rewards'],
+                                next_idx=index['next_idx'],
+                                dones=index['dones'],
+                                discounts=index['discounts'])
+        self.fields = BATCH_FIELDS + (('discounts',) if self.nstep > 1 else ())
+
+        if self.storage != 'float32':
+            # obs, action은 float16/bfloat16, done은 uint8로 들고 있다가 batch만 float32로
+            if self.device is not None:
+                self.quantization_error = quantization_error({key: self.dataset[key] for key in ENCODED_FIELDS}, self.storage)
+            else:
+                # cache가 있으면 encode한 array도 cache에 저장해서 mmap (float32 cache처럼 page cache 공유)
+                encoded, self.quantization_error = load_encoded_fields(self.dataset, self.storage, cache_path)
+                self.dataset.update(encoded)
+            self.dataset['dones'] = np.asarray(self.dataset['dones']).astype(np.uint8)
+            print("[storage] %s max quantization error : %s" % (self.storage, format_errors(self.quantization_error)))
+
+        if self.device is not None:
+            # dataset 전체를 한번만 device로 올리고 batch는 device 위에서 index_select
+            dtypes = dict(rewards=torch.float32, discounts=torch.float32, next_idx=torch.long, dones=torch.float32 if self.storage == 'float32' else torch.uint8)
+            self.dataset = {key: torch.tensor(np.asarray(value), device=self.device).to(dtypes.get(key, TORCH_STORAGE[self.storage])) for key, value in self.dataset.items()}
+
+        if self.sampling == 'prioritized':
+            self.sampler = PrioritizedSampler(self.len)
+            self.sampler.add(np.arange(self.len))
+        elif self.sampling == 'epoch':
+            # epoch마다 한번 섞고 batch는 그 안에서 연속 slice (view)로
+            # copy: dataset 전체를 섞은 순서로 복사, block: batch 크기 block의 순서만 섞음 (복사 없음)
+            assert epoch_shuffle in ('copy', 'block')
+            self.epoch_shuffle = epoch_shuffle
+            self.seed = seed
+            self.rng = np.random.default_rng(seed)
+            if self.device is not None:
+                self.generator = torch.Generator(device=self.device)
+                self.generator.manual_seed(seed if seed is not None else int(self.rng.integers(2**62)))
+            self.epoch = 0
+            self.epoch_data = None
+            self.epoch_order = None
+            self.epoch_offset = 0
+            self.epoch_batch_size = None
+            self.epoch_pos = 0
+        elif self.sampling != 'uniform':
+            raise ValueError("unknown sampling: " + str(self.sampling))
+
+    def rows(self,data,key,idx):
+        # idx: index array / tensor 또는 slice. n-step이면 next_observations는 bootstrap row (next_idx[idx])에서
+        if key == 'next_observations' and 'next_idx' in data:
+            idx = data['next_idx'][idx]
+        if self.device is not None and not isinstance(idx, slice):
+            return data[key].index_select(0, idx)
+        return data[key][idx]
+
+    def gather(self,idx):
+        if self.device is not None:
+            return self.to_batch(tuple(self.rows(self.dataset, key, idx).float() for key in self.fields))
+        if self.storage == 'float32':
+            return self.to_batch(tuple(self.rows(self.dataset, key, idx) for key in self.fields))
+        return self.to_batch(tuple(decode(self.rows(self.dataset, key, idx), self.storage) if key in ENCODED_FIELDS else np.asarray(self.rows(self.dataset, key, idx), dtype=np.float32) for key in self.fields))
+
+    def to_batch(self,values):
+        # n-step이면 할인율을 extras로
+        if self.nstep > 1:
+            return values[:5] + (dict(discount=values[5]),)
+        return values
+
     def get_data(self,batch_size=256):
-        idx = np.random.choice(self.len, batch_size)
-        return self.dataset['observations'][idx], self.dataset['actions'][idx], self.dataset['rewards'][idx], self.dataset['next_observations'][idx], self.dataset['dones'][idx]
+        if self.sampling == 'prioritized':
+            return self.prioritized_data(batch_size)
+        if self.sampling == 'epoch':
+            return self.epoch_data_batch(batch_size)
+        if self.device is not None:
+            idx = torch.randint(self.len, (batch_size,), device=self.device)
+        else:
+            idx = np.random.choice(self.len, batch_size)
+        return self.gather(idx)
+
+    def get_seed_data(self,batch_size,rngs):
+        # multi-seed 학습 (MultiSeed_TD3_Agent): seed마다 자기 rng로 uniform sampling한 batch를 (N, B, ...)로 쌓아서
+        idx = np.stack([rng.integers(self.len, size=batch_size) for rng in rngs]).reshape(-1)
+        if self.device is not None:
+            idx = torch.as_tensor(idx, device=self.device)
+        batch = self.gather(idx)
+        shape = lambda x: x.reshape((len(rngs), batch_size) + tuple(x.shape[1:]))
+        if len(batch) > 5:
+            return tuple(shape(x) for x in batch[:5]) + ({key: shape(value) for key, value in batch[5].items()},)
+        return tuple(shape(x) for x in batch)
+
+    def prioritized_data(self,batch_size=256):
+        idx, weights = self.sampler.sample(batch_size, self.len)
+        extras = dict(idx=idx, weights=weights, update_priorities=self.update_priorities)
+        if self.device is not None:
+            extras['weights'] = torch.as_tensor(weights, device=self.device)
+            batch = self.gather(torch.as_tensor(idx, device=self.device))
+        else:
+            batch = self.gather(idx)
+        if len(batch) > 5:
+            extras.update(batch[5])
+        return batch[:5] + (extras,)
+
+    def update_priorities(self, idx, priorities):
+        self.sampler.update(idx, priorities)
+
+    def permutation(self, n):
+        if self.device is not None:
+            return torch.randperm(n, generator=self.generator, device=self.device)
+        return self.rng.permutation(n)
+
+    def start_epoch(self,batch_size=256):
+        if self.epoch_shuffle == 'copy':
+            perm = self.permutation(self.len)
+            self.epoch_data = {key: self.rows(self.dataset, key, perm) for key in self.fields}
+        else:
+            # block 경계를 epoch마다 random offset만큼 밀어서 (끝을 넘는 block은 앞으로 wrap) 모든 row가 sample되도록
+            self.epoch_data = self.dataset
+            self.epoch_order = self.permutation(self.len // batch_size)
+            self.epoch_offset = int(self.permutation(batch_size)[0])
+        self.epoch_batch_size = batch_size
+        self.epoch_pos = 0
+
+    def epoch_data_batch(self,batch_size=256):
+        # 남은 row가 batch보다 적거나 batch 크기가 바뀌면 다음 epoch
+        if self.epoch_data is None or self.epoch_pos + batch_size > self.len or batch_size != self.epoch_batch_size:
+            if self.epoch_data is not None:
+                self.epoch += 1
+            self.start_epoch(batch_size)
+        if self.epoch_shuffle == 'copy':
+            start = self.epoch_pos
+        else:
+            start = self.epoch_offset + int(self.epoch_order[self.epoch_pos // batch_size]) * batch_size
+        self.epoch_pos += batch_size
+        if start + batch_size > self.len:
+            # epoch당 (block mode) 많아야 한 block만 wrap해서 index로 gather
+            if self.device is not None:
+                return self.gather(torch.arange(start, start + batch_size, device=self.device) % self.len)
+            return self.gather(np.arange(start, start + batch_size) % self.len)
+        return self.slice(self.epoch_data, start, start + batch_size)
 
+    def slice(self,data,start,end):
+        rows = slice(start, end)
+        if self.device is not None:
+            return self.to_batch(tuple(self.rows(data, key, rows).float() for key in self.fields))
+        if self.storage == 'float32':
+            return self.to_batch(tuple(self.rows(data, key, rows) for key in self.fields))
+        return self.to_batch(tuple(decode(self.rows(data, key, rows), self.storage) if key in ENCODED_FIELDS else np.asarray(self.rows(data, key, rows), dtype=np.float32) for key in self.fields))
 
+    def iterate_epoch(self,batch_size=256):
+        # 한 epoch의 batch를 끝까지 (다음 get_data는 새 epoch부터)
+        self.start_epoch(batch_size)
+        for _ in range(self.len // batch_size):
+            yield self.epoch_data_batch(batch_size)
+        self.epoch += 1
+        self.epoch_data = None
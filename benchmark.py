@@ -0,0 +1,239 @@
+import time
+from copy import copy
+import numpy as np
+import torch
+from Model.model import Policy
+from Model.class_model import SAC_Agent, SAC_CQL_Agent, TD3_Agent, BC_agent, MultiSeed_TD3_Agent, unpack_batch, to_tensor
+from Utils.arguments import get_args
+from Utils.thread_tuning import configure_threads
+
+# synthetic batch로 update step 시간 비교 (gym, d4rl 필요 없음, autocast의 --benchmark_eval_episodes만 필요)
+# python benchmark.py --benchmark cql_policy --device_train cpu
+
+args = get_args()
+configure_threads(args, 'TD3' if args.benchmark_agent in ('TD3', 'BC') else 'SAC_CQL')
+o_dim, a_dim = 17, 6 # halfcheetah
+
+
+def random_batch(batch_size):
+  return (np.random.randn(batch_size, o_dim).astype(np.float32),
+          np.random.uniform(-1, 1, (batch_size, a_dim)).astype(np.float32),
+          np.random.randn(batch_size).astype(np.float32),
+          np.random.randn(batch_size, o_dim).astype(np.float32),
+          (np.random.rand(batch_size) < 0.01).astype(np.float32))
+
+def synchronize():
+  if torch.device(args.device_train).type == 'cuda':
+    torch.cuda.synchronize()
+
+def step_time(step_fn, batches, warmup=10):
+  # step당 평균 시간 (ms)
+  for batch in batches[:warmup]:
+    step_fn(batch)
+  synchronize()
+  start = time.perf_counter()
+  for batch in batches:
+    step_fn(batch)
+  synchronize()
+  return (time.perf_counter() - start) / len(batches) * 1000
+
+def count_forwards(module, step_fn, batch):
+  count = [0]
+  handle = module.register_forward_hook(lambda *_: count.__setitem__(0, count[0] + 1))
+  step_fn(batch)
+  handle.remove()
+  return count[0]
+
+
+def sac_cql_separate_forwards(agent, batch):
+  # 예전 SAC_CQL_Agent.train: actor, alpha, TD target, CQL마다 policy forward를 따로
+  (state_batch, action_batch, reward_batch, next_state_batch, done_batch), extras = unpack_batch(batch)
+  state_batch, action_batch, reward_batch, next_state_batch, done_batch = [
+    to_tensor(x, args.device_train) for x in (state_batch, action_batch, reward_batch, next_state_batch, done_batch)]
+  pi_loss    = agent.get_pi_loss(state_batch)
+  with torch.no_grad():
+    next_action_batch, next_log_pi = agent.pi(next_state_batch)
+  current = agent.pi(state_batch, repeat=agent.cql_n_actions)
+  with torch.no_grad():
+    next_ = agent.pi(next_state_batch, repeat=agent.cql_n_actions)
+  samples = (torch.cat([current[0][:, :1], current[0]], 1), torch.cat([current[1][:, :1], current[1]], 1),
+             torch.cat([next_action_batch[:, None], next_[0]], 1), torch.cat([next_log_pi[:, None], next_[1]], 1))
+  q_loss     = agent.get_q_loss(state_batch, action_batch, reward_batch, next_state_batch, done_batch, extras, samples)
+  alpha_loss = agent.get_alpha_loss(state_batch)
+
+  agent.alpha_opt.zero_grad()
+  alpha_loss.backward()
+  agent.alpha_opt.step()
+  agent.pi_opt.zero_grad()
+  pi_loss.backward()
+  agent.pi_opt.step()
+  agent.q_opt.zero_grad()
+  q_loss.backward()
+  agent.q_opt.step()
+  agent.target_q_update()
+
+def bench_cql_policy():
+  agent = SAC_CQL_Agent(o_dim, a_dim, args)
+  batches = [random_batch(args.SAC_batch_size) for _ in range(args.benchmark_steps)]
+  for name, step_fn in (("separate", lambda batch: sac_cql_separate_forwards(agent, batch)),
+                        ("shared  ", agent.train)):
+    n_forwards = count_forwards(agent.pi, step_fn, batches[0])
+    print("[cql_policy] %s : %.2f ms/step, policy forward %d/step" % (name, step_time(step_fn, batches), n_forwards))
+
+
+def make_agent(name, dims=(o_dim, a_dim), **overrides):
+  # benchmark용 agent와 batch 하나로 update 한번 하는 함수
+  agent_args = copy(args)
+  for key, value in overrides.items():
+    setattr(agent_args, key, value)
+  if name == "SAC":
+    agent = SAC_Agent(*dims, agent_args)
+    return agent, agent.train_off
+  if name == "SAC_CQL":
+    agent = SAC_CQL_Agent(*dims, agent_args)
+    return agent, agent.train
+  if name == "TD3":
+    agent = TD3_Agent(*dims, agent_args)
+    return agent, agent.train_off
+  agent = BC_agent(*dims, agent_args)
+  return agent, agent.train_weightedQ
+
+def eval_return(agent, env, episodes):
+  # *_train.py의 evaluation과 같은 방식, episode 평균
+  action_max = env.action_space.high[0]
+  returns = []
+  for _ in range(episodes):
+    state = env.reset()
+    total_reward = 0
+    for step in range(env.spec.max_episode_steps):
+      action = agent.select_action(state.reshape([1,-1]), eval=True)
+      state, rwd, done, _ = env.step(action*action_max)
+      total_reward += rwd
+      if done:
+        break
+    returns.append(total_reward)
+  return np.mean(returns)
+
+def bench_compile():
+  # 같은 synthetic batch로 eager / torch.compile update의 steps/sec. 첫 호출 (compile 시간)은 따로
+  batches = [random_batch(args.SAC_batch_size)] * args.benchmark_steps
+  for compile_ in (False, True):
+    torch.manual_seed(0)
+    agent, step_fn = make_agent(args.benchmark_agent, compile=compile_, compile_sac_cql=compile_)
+    start = time.perf_counter()
+    step_fn(batches[0])
+    synchronize()
+    first_step = time.perf_counter() - start
+    ms = step_time(step_fn, batches)
+    print("[compile] %s %-8s : %.1f steps/sec (first step %.1f s)" % (
+      args.benchmark_agent, "compiled" if compile_ else "eager", 1000 / ms, first_step))
+
+
+def bench_autocast():
+  # float32 / bfloat16 autocast를 같은 seed로: steps/sec, --benchmark_eval_episodes > 0이면 task_name dataset으로
+  # benchmark_steps 학습한 뒤의 평가 return까지
+  if args.benchmark_eval_episodes > 0:
+    import gym
+    import d4rl
+    from Utils.utils import d4rl_dataset, dataset_kwargs
+    env = gym.make(args.task_name)
+    dims = (env.observation_space.shape[0], env.action_space.shape[0])
+    dataset = d4rl_dataset(env.unwrapped, **dataset_kwargs(args))
+  else:
+    dims = (o_dim, a_dim)
+  for dtype in (None, "bfloat16"):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    agent, step_fn = make_agent(args.benchmark_agent, dims, autocast=dtype)
+    if args.benchmark_eval_episodes > 0:
+      env.seed(0)
+      batches = [dataset.get_data(args.SAC_batch_size) for _ in range(args.benchmark_steps)]
+    else:
+      batches = [random_batch(args.SAC_batch_size) for _ in range(args.benchmark_steps)]
+    ms = step_time(step_fn, batches)
+    line = "[autocast] %s %-8s : %.1f steps/sec" % (args.benchmark_agent, dtype or "float32", 1000 / ms)
+    if args.benchmark_eval_episodes > 0:
+      line += ", return %.2f" % eval_return(agent, env, args.benchmark_eval_episodes)
+    print(line)
+
+
+def bench_multi_seed():
+  # TD3-CQL seed N개 (--seeds): TD3_Agent N개를 차례로 vs MultiSeed_TD3_Agent의 vmap update 한번, seed당 steps/sec
+  n = len(args.seeds)
+  batches = [tuple(np.stack(x) for x in zip(*[random_batch(args.SAC_batch_size) for _ in range(n)]))
+             for _ in range(args.benchmark_steps)]
+  agents = []
+  for seed in args.seeds:
+    torch.manual_seed(seed)
+    agents.append(TD3_Agent(o_dim, a_dim, args))
+  separate = lambda batch: [agent.train_off(tuple(x[i] for x in batch), cql=True) for i, agent in enumerate(agents)]
+  multi_seed = MultiSeed_TD3_Agent(o_dim, a_dim, args, args.seeds)
+  for name, step_fn in (("separate", separate), ("vmap    ", lambda batch: multi_seed.train_off(batch, cql=True))):
+    ms = step_time(step_fn, batches)
+    print("[multi_seed] %d seeds %s : %.1f steps/sec per seed" % (n, name, 1000 / ms))
+
+
+def bench_multi_seed_parity():
+  # MultiSeed_TD3_Agent가 TD3_Agent N개 train_off와 같은 update를 하는지: 모든 noise를 0 (random action은 -1)으로 고정하고
+  # 같은 batch로 benchmark_steps번 update한 뒤 seed별 parameter (q, pi, target) 최대 차이
+  n = len(args.seeds)
+  batches = [tuple(np.stack(x) for x in zip(*[random_batch(args.SAC_batch_size) for _ in range(n)]))
+             for _ in range(args.benchmark_steps)]
+  for cql in (False, True):
+    agents = []
+    for seed in args.seeds:
+      torch.manual_seed(seed)
+      agents.append(TD3_Agent(o_dim, a_dim, args))
+    multi_seed = MultiSeed_TD3_Agent(o_dim, a_dim, args, args.seeds)
+    multi_seed.seed_random = lambda shape, uniform=False: torch.zeros((n,) + tuple(shape), device=args.device_train)
+    randn_like, uniform_ = torch.randn_like, torch.Tensor.uniform_
+    torch.randn_like = torch.zeros_like
+    torch.Tensor.uniform_ = lambda x, low=0, high=1: x.fill_(low)
+    try:
+      for batch in batches:
+        multi_seed.train_off(batch, cql=cql)
+        for i, agent in enumerate(agents):
+          agent.train_off(tuple(x[i] for x in batch), cql=cql)
+    finally:
+      torch.randn_like, torch.Tensor.uniform_ = randn_like, uniform_
+    diff = max(float((param - getattr(multi_seed, net)[key][i]).detach().abs().max())
+               for i, agent in enumerate(agents) for net in ('q', 'pi', 'target_q', 'target_pi')
+               for key, param in getattr(agent, net).named_parameters())
+    print("[multi_seed_parity] %d seeds cql=%s, %d steps : max |param diff| %.2e" % (n, cql, args.benchmark_steps, diff))
+
+
+def bench_select_action():
+  # env step당 action 하나: 예전 select_action (device_train, autograd, 매번 새 tensor) vs InferencePolicy (device_eval).
+  # InferencePolicy는 policy가 그대로일 때 / 매 step 바뀔 때 (online 학습, 매번 sync) 따로. p50/p99 (us)
+  agent, _ = make_agent(args.benchmark_agent)
+  policy = agent.bc if args.benchmark_agent == "BC" else agent.pi
+  if isinstance(policy, Policy):
+    legacy = lambda o: policy(to_tensor(o.reshape([1,-1]), args.device_train), True)[0].cpu().detach().numpy()[0]
+  else:
+    legacy = lambda o: policy(to_tensor(o.reshape([1,-1]), args.device_train)).cpu().detach().numpy()[0]
+  def touch():
+    with torch.no_grad():
+      for p in policy.parameters():
+        p.add_(0)
+  observations = np.random.randn(args.benchmark_steps, o_dim).astype(np.float32)
+  for name, act_fn, before in (("legacy       ", legacy, None),
+                               ("inference    ", lambda o: agent.select_action(o, eval=True), None),
+                               ("inference+sync", lambda o: agent.select_action(o, eval=True), touch)):
+    times = []
+    for o in observations:
+      if before is not None:
+        before()
+      synchronize()
+      start = time.perf_counter()
+      act_fn(o)
+      synchronize()
+      times.append(time.perf_counter() - start)
+    times = np.array(times[10:]) * 1e6
+    print("[select_action] %s %s : p50 %.1f us, p99 %.1f us" % (args.benchmark_agent, name, np.percentile(times, 50), np.percentile(times, 99)))
+
+
+BENCHMARKS = dict(cql_policy=bench_cql_policy, compile=bench_compile, autocast=bench_autocast, multi_seed=bench_multi_seed,
+                  multi_seed_parity=bench_multi_seed_parity, select_action=bench_select_action)
+
+if __name__ == "__main__":
+  BENCHMARKS[args.benchmark]()
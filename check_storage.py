@@ -0,0 +1,17 @@
+import gym
+import d4rl
+from Utils.arguments import get_args
+from Utils.utils import d4rl_dataset, ENCODED_FIELDS
+from Utils.precision import STORAGE_DTYPES, quantization_error, format_errors
+
+# --task_name의 d4rl dataset을 float16/bfloat16으로 저장했을 때 field (obs, action, next obs)별 최대 절대 오차
+# python check_storage.py --task_name hopper-medium-v2 [--dataset_cache_dir ./d4rl_cache]
+
+args = get_args()
+env = gym.make(args.task_name)
+dataset = d4rl_dataset(env.unwrapped, cache_dir=args.dataset_cache_dir)
+fields = {key: dataset.dataset[key] for key in ENCODED_FIELDS}
+print("[storage] %s : %d rows" % (args.task_name, dataset.len))
+for storage in STORAGE_DTYPES:
+  if storage != 'float32':
+    print("[storage] %s max quantization error : %s" % (storage, format_errors(quantization_error(fields, storage))))
@@ -0,0 +1,46 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import torch
+from Model.model import Policy, Det_Policy
+from Model.numpy_policy import NumpyPolicy, save_policy
+from Utils.arguments import get_args
+
+# {'policy': state_dict} checkpoint (BC_train.py, SAC_train.py ...)의 policy를 torch 없이 돌릴 .npz로 저장하고
+# torch module과 결과 비교 (parity), runtime이 torch를 import하지 않는지도 확인
+# python export_policy.py --policy_checkpoint ./model_save/bc/bc_xxx.pt [--export_path policy.npz]
+
+args = get_args()
+assert args.policy_checkpoint is not None, "--policy_checkpoint"
+export_path = args.export_path or os.path.splitext(args.policy_checkpoint)[0] + ".npz"
+
+state_dict = torch.load(args.policy_checkpoint, map_location='cpu')['policy']
+save_policy(export_path, {key: value.numpy() for key, value in state_dict.items()})
+
+# parity: 같은 weight의 torch module (Policy는 eval=True, tanh(mu))
+stochastic = 'fc3_mu.weight' in state_dict
+o_dim, h_size = state_dict['fc1.weight'].shape[1], state_dict['fc1.weight'].shape[0]
+a_dim = state_dict[('fc3_mu' if stochastic else 'fc3') + '.weight'].shape[0]
+module = (Policy if stochastic else Det_Policy)(o_dim, a_dim, h_size)
+module.load_state_dict(state_dict)
+numpy_policy = NumpyPolicy(export_path)
+
+observations = np.random.randn(1024, o_dim).astype(np.float32) * 3
+with torch.no_grad():
+  if stochastic:
+    expected = module(torch.as_tensor(observations), eval=True)[0].numpy()
+  else:
+    expected = module(torch.as_tensor(observations)).numpy()
+batch_error = np.abs(numpy_policy(observations) - expected).max()
+single_error = max(np.abs(numpy_policy(o) - e).max() for o, e in zip(observations[:16], expected[:16]))
+print("[export] %s -> %s (%s, o_dim %d, a_dim %d, hidden %d, %.1f KB)" % (
+  args.policy_checkpoint, export_path, type(module).__name__, o_dim, a_dim, h_size, os.path.getsize(export_path) / 1024))
+print("[parity] max |numpy - torch| : batch %.2e, single %.2e" % (batch_error, single_error))
+assert batch_error < 1e-5 and single_error < 1e-5, "numpy policy does not match torch"
+
+root = os.path.dirname(os.path.abspath(__file__))
+subprocess.run([sys.executable, "-c", "import sys, numpy; from Model.numpy_policy import NumpyPolicy; "
+                "NumpyPolicy(sys.argv[1])(numpy.zeros(%d)); assert 'torch' not in sys.modules, 'runtime imported torch'" % o_dim,
+                os.path.abspath(export_path)], cwd=root, check=True)
+print("[parity] runtime ok without torch")